@@ -0,0 +1,11 @@
+from flask import request
+from hubmap_commons.hm_auth import AuthHelper
+
+
+def is_data_admin() -> bool:
+    """Whether the current request carries a token with data admin privileges"""
+    auth_helper_instance = AuthHelper.instance()
+    token = auth_helper_instance.getAuthorizationTokens(request.headers)
+    if not isinstance(token, str):
+        return False
+    return auth_helper_instance.has_data_admin_privs(token) is True
@@ -0,0 +1,224 @@
+"""
+Work out what changed between two rule chains, and reclassify only the
+records whose outcome could have changed.
+"""
+
+import difflib
+import json
+import logging
+from collections import defaultdict
+from typing import Iterable, Iterator
+
+from rule_engine import EngineError
+
+from lib.rule_ast import iter_conjuncts, literal_constraint
+from lib.rule_chain import (
+    NoMatchException,
+    NoteRule,
+    RuleChain,
+    RuleLogicException,
+    normalize_metadata,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def rule_signature(rule) -> tuple:
+    """Two rules with equal signatures behave identically"""
+    return (rule.rule_type, rule.match_rule.text, rule.val_rule.text)
+
+
+class ChainDiff:
+    """
+    The rule-by-rule difference between two chains.
+
+    Rules are aligned with difflib, so a rule counts as unchanged only if an
+    identical rule appears in the same relative order in both chains. A
+    moved rule shows up as removed from the old chain and added to the new.
+    """
+
+    def __init__(self, old_chain: RuleChain, new_chain: RuleChain):
+        self.old_chain = old_chain
+        self.new_chain = new_chain
+        matcher = difflib.SequenceMatcher(
+            a=[rule_signature(elt) for elt in old_chain.links],
+            b=[rule_signature(elt) for elt in new_chain.links],
+            autojunk=False,
+        )
+        self.removed = []  # indexes into old_chain.links
+        self.added = []  # indexes into new_chain.links
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != "equal":
+                self.removed.extend(range(i1, i2))
+                self.added.extend(range(j1, j2))
+        self.notes_changed = any(
+            isinstance(old_chain.links[idx], NoteRule) for idx in self.removed
+        ) or any(isinstance(new_chain.links[idx], NoteRule) for idx in self.added)
+
+    def is_empty(self) -> bool:
+        return not (self.removed or self.added)
+
+    def affected_values(self) -> dict:
+        """
+        Collect the attribute values tested by the changed rules, e.g.
+        {'assay_type': ['AF'], 'dataset_type': ['MERFISH']}.
+        """
+        values = defaultdict(set)
+        changed = [self.old_chain.links[idx] for idx in self.removed] + [
+            self.new_chain.links[idx] for idx in self.added
+        ]
+        for elt in changed:
+            for conjunct in iter_conjuncts(elt.match_rule.statement.expression):
+                constraint = literal_constraint(conjunct)
+                if constraint:
+                    symbol, literals = constraint
+                    values[symbol].update(str(val) for val in literals)
+        return {symbol: sorted(vals) for symbol, vals in sorted(values.items())}
+
+    def summary(self) -> dict:
+        return {
+            "old_content_hash": self.old_chain.content_hash,
+            "new_content_hash": self.new_chain.content_hash,
+            "removed_rules": [
+                self.old_chain.links[idx].to_record() for idx in self.removed
+            ],
+            "added_rules": [
+                self.new_chain.links[idx].to_record() for idx in self.added
+            ],
+            "notes_changed": self.notes_changed,
+            "affected_values": self.affected_values(),
+        }
+
+    def could_change(self, rec: dict) -> bool:
+        """
+        Return False only if classifying rec with the new chain is certain to
+        give the same result as the old chain.
+
+        If no note changed and rec matches none of the removed or added
+        rules, then the first rule it matches, and every note seen before
+        that rule, is the same in both chains.
+        """
+        if self.is_empty():
+            return False
+        if self.notes_changed:
+            return True
+        return _matches_any(self.old_chain, self.removed, rec) or _matches_any(
+            self.new_chain, self.added, rec
+        )
+
+
+def _matches_any(chain: RuleChain, indexes: list, rec: dict) -> bool:
+    """
+    Check whether rec matches any of the given rules of chain, seeing the
+    notes left by the rules before each one as RuleChain.apply would.
+    """
+    wanted = set(indexes)
+    if not wanted:
+        return False
+    ctx = {}
+    try:
+        for idx, elt in enumerate(chain.links[: max(wanted) + 1]):
+            if idx in wanted:
+                if elt.match_rule.matches(rec | ctx):
+                    return True
+            elif isinstance(elt, NoteRule) and elt.match_rule.matches(rec | ctx):
+                ctx.update(elt.val_rule.evaluate(rec | ctx))
+    except EngineError:
+        return True  # let the full classification report the problem
+    return False
+
+
+def classify(chain: RuleChain, metadata: dict) -> dict:
+    """Apply the chain to normalized metadata, mapping no match to {} as the routes do"""
+    try:
+        return chain.apply(metadata)
+    except NoMatchException:
+        return {}
+    except RuleLogicException as excp:
+        return {"error": str(excp)}
+
+
+def reclassify(
+    diff: ChainDiff, corpus: Iterable[dict], stats: dict = None
+) -> Iterator[dict]:
+    """Reclassify the records of a stored corpus which the diff could affect.
+
+    Parameters
+    ----------
+    diff : ChainDiff
+        The difference between the chain that produced the stored results and
+        the new chain.
+    corpus : Iterable[dict]
+        Records with keys "uuid", "metadata" (the projected metadata) and
+        "result" (the previous classification result, {} for no match).
+    stats : dict, optional
+        If given, filled in with "records", "rerun" and "changed" counts.
+
+    Yields
+    ------
+    dict
+        {"uuid", "previous", "current"} for each record whose result changed.
+    """
+    stats = {} if stats is None else stats
+    stats.update({"records": 0, "rerun": 0, "changed": 0})
+    for entry in corpus:
+        stats["records"] += 1
+        metadata = normalize_metadata(dict(entry["metadata"]))
+        if not diff.could_change(metadata):
+            continue
+        stats["rerun"] += 1
+        current = classify(diff.new_chain, metadata)
+        if current != entry.get("result"):
+            stats["changed"] += 1
+            yield {
+                "uuid": entry.get("uuid"),
+                "previous": entry.get("result"),
+                "current": current,
+            }
+
+
+def load_corpus(corpus_path: str) -> Iterator[dict]:
+    """Read a corpus stored as newline-delimited JSON records"""
+    with open(corpus_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def reload_report(
+    old_chain: RuleChain, new_chain: RuleChain, corpus: Iterable[dict] = None
+) -> dict:
+    """Describe a chain reload, reclassifying a stored corpus if one is given.
+
+    Parameters
+    ----------
+    old_chain : RuleChain
+        The chain which was active before the reload, or None.
+    new_chain : RuleChain
+        The newly installed chain.
+    corpus : Iterable[dict], optional
+        Stored results of the old chain, in the form read by reclassify.
+
+    Returns
+    -------
+    dict
+        The ChainDiff summary, plus "changes" and "reclassified" counts when
+        a corpus was reclassified, and "slow_rules" when the old chain's
+        rule costs were monitored.
+    """
+    if old_chain is None:
+        return {"new_content_hash": new_chain.content_hash}
+    diff = ChainDiff(old_chain, new_chain)
+    report = diff.summary()
+    if old_chain.cost_monitor is not None:
+        slow_rules = old_chain.cost_monitor.describe()
+        new_records = [elt.to_record() for elt in new_chain.links]
+        for rule in slow_rules["flagged"]:
+            rule["in_new_chain"] = rule["rule"] in new_records
+        report["slow_rules"] = slow_rules
+    if corpus is not None and not diff.is_empty():
+        stats = {}
+        report["changes"] = list(reclassify(diff, corpus, stats))
+        report["reclassified"] = stats
+        logger.info(f"Reclassification after reload: {stats}")
+    return report
@@ -0,0 +1,118 @@
+"""
+Sharing the active rule chain between the worker processes of a host.
+
+The worker which reloads or patches the chain writes the chain's validated
+records to ``<dir>/<content hash>.json`` and then updates a small version
+stamp file in the same directory. Every worker maps the stamp into memory, so
+checking it on each request is a read of a few bytes with no system call;
+when it changes, the worker loads the new chain from its artifact instead of
+fetching and validating it again. Only the artifact of the current stamp is
+kept.
+
+The stamp also records the source the chain was published for, so workers
+of a later deploy with a different source ignore it.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Optional
+
+STAMP_FILE = "rule_chain.stamp"
+
+# Generation, content hash, version name, source, generation again. The
+# generation is written at both ends, last at the front, so a reader which
+# sees two different values knows it caught a write in progress.
+STAMP_FORMAT = struct.Struct("<Q64s64s64sQ")
+
+
+class ChainStamp:
+    def __init__(self, shared_dir: str):
+        self.shared_dir = Path(shared_dir)
+        self.shared_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.shared_dir / STAMP_FILE
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < STAMP_FORMAT.size:
+                os.ftruncate(fd, STAMP_FORMAT.size)
+            self.map = mmap.mmap(fd, STAMP_FORMAT.size)
+        finally:
+            os.close(fd)
+
+    def read(self) -> Optional[tuple]:
+        """Return (generation, content hash, version, source), or None if the
+        stamp has never been written or is being written right now"""
+        generation, content_hash, version, source, check = STAMP_FORMAT.unpack(
+            self.map[: STAMP_FORMAT.size]
+        )
+        if generation == 0 or generation != check:
+            return None
+        return (
+            generation,
+            content_hash.rstrip(b"\0").decode(),
+            version.rstrip(b"\0").decode() or None,
+            source.rstrip(b"\0").decode(),
+        )
+
+    def write(self, content_hash: str, version: str = None, source: str = "") -> int:
+        """Publish a new stamp, returning its generation"""
+        with open(self.path, "r+b") as lock_file:
+            # Serialize writers across processes
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            generation = STAMP_FORMAT.unpack(self.map[: STAMP_FORMAT.size])[0] + 1
+            record = STAMP_FORMAT.pack(
+                generation,
+                content_hash.encode(),
+                (version or "").encode()[:64],
+                source.encode()[:64],
+                generation,
+            )
+            tail = STAMP_FORMAT.size - 8
+            self.map[tail:] = record[tail:]
+            self.map[8:tail] = record[8:tail]
+            self.map[:8] = record[:8]
+            self.map.flush()
+        return generation
+
+    def artifact_path(self, content_hash: str) -> Path:
+        return self.shared_dir / f"{content_hash}.json"
+
+    def write_artifact(self, content_hash: str, json_recs: list):
+        """Write a chain's records, atomically so readers never see part of it"""
+        path = self.artifact_path(content_hash)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(json_recs, f)
+        os.replace(tmp_path, path)
+
+    def read_artifact(self, content_hash: str) -> list:
+        with open(self.artifact_path(content_hash)) as f:
+            return json.load(f)
+
+    def prune_artifacts(self, keep: str):
+        """Remove the artifacts of every chain but the one with hash keep.
+
+        A worker still switching to a removed chain fails to read it, and
+        picks up the newer stamp on its next check instead.
+        """
+        for path in self.shared_dir.glob("*.json"):
+            if path != self.artifact_path(keep):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass  # pruned by another worker
+
+
+_stamps = {}
+_stamps_lock = threading.Lock()
+
+
+def get_chain_stamp(shared_dir: str) -> ChainStamp:
+    with _stamps_lock:
+        if shared_dir not in _stamps:
+            _stamps[shared_dir] = ChainStamp(shared_dir)
+        return _stamps[shared_dir]
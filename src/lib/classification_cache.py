@@ -0,0 +1,262 @@
+"""
+A second-level cache of classification results, which can be shared by the
+workers of a host (SQLite) or by every replica (Redis).
+
+Keys are namespaced by the content hash of the chain which computed the
+result, so a reload or patch never serves results of an older chain. The
+backend is chosen by the ``CLASSIFICATION_CACHE`` config value:
+
+``memory``
+    A per-process LRU, mostly useful for tests and single-process runs.
+``sqlite:///path/to/cache.db``
+    A file shared by the processes of one host.
+``redis://host:port/db``
+    Any Redis-protocol server, shared across hosts. Needs the redis package.
+
+Entries expire after ``CLASSIFICATION_CACHE_TTL`` seconds (default 600),
+since the entity behind a uuid may change.
+
+The cache is only an optimization: if the backend fails, e.g. because the
+Redis server is unreachable, the error is logged and treated as a miss.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from flask import current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 600
+
+# How often the SQLite backend deletes expired entries, in seconds
+PURGE_INTERVAL = 300
+
+
+def uuid_cache_key(chain_hash: str, uuid: str, token: Optional[str]) -> str:
+    """
+    The key for an entity's result. What the entity service returns depends
+    on the caller's token, so results are only shared between callers with
+    the same token; it is hashed so the cache never holds it.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()[:16] if token else "-"
+    return f"{chain_hash}:uuid:{uuid}:{token_hash}"
+
+
+def metadata_cache_key(chain_hash: str, fingerprint: str) -> str:
+    """The key for the result of classifying a metadata dict directly"""
+    return f"{chain_hash}:metadata:{fingerprint}"
+
+
+class ClassificationCache:
+    """Interface of the cache backends. Values are JSON-serializable dicts."""
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value: dict) -> None:
+        self.set_many({key: value})
+
+    def get_many(self, keys: Iterable[str]) -> dict:
+        """Return the cached values of those keys which are present"""
+        raise NotImplementedError
+
+    def set_many(self, items: dict) -> None:
+        raise NotImplementedError
+
+
+class MemoryCache(ClassificationCache):
+    def __init__(self, max_size: int = 10000, ttl: float = DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.time()
+        rslt = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                rslt[key] = entry[1]
+        return rslt
+
+    def set_many(self, items):
+        expires = time.time() + self.ttl
+        with self.lock:
+            for key, value in items.items():
+                self.entries[key] = (expires, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class SQLiteCache(ClassificationCache):
+    """A cache file shared by the processes of one host"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    """
+
+    def __init__(self, db_path: str, ttl: float = DEFAULT_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._next_purge = time.time() + PURGE_INTERVAL
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys):
+        keys = list(keys)
+        rslt = {}
+        conn = self._connection()
+        # Stay well under SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            query = (
+                "SELECT key, value FROM cache WHERE expires >= ?"
+                f" AND key IN ({', '.join('?' * len(chunk))})"
+            )
+            for key, value in conn.execute(query, [time.time()] + chunk):
+                rslt[key] = json.loads(value)
+        return rslt
+
+    def set_many(self, items):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                [
+                    (key, json.dumps(value), now + self.ttl)
+                    for key, value in items.items()
+                ],
+            )
+        # Without this the file only ever grows
+        if now >= self._next_purge:
+            self._next_purge = now + PURGE_INTERVAL
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        with self._connection() as conn:
+            return conn.execute(
+                "DELETE FROM cache WHERE expires < ?", (time.time(),)
+            ).rowcount
+
+
+class RedisCache(ClassificationCache):
+    """A cache on a Redis-protocol server, shared by every replica.
+
+    Pass either the server's URL or a ready client, e.g. a local stand-in
+    such as fakeredis.FakeRedis.
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        client=None,
+        ttl: float = DEFAULT_TTL,
+        prefix: str = "assayclassifier:",
+    ):
+        if client is None:
+            if redis is None:
+                raise ImportError("The redis cache backend requires the redis package")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {
+            key: json.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def set_many(self, items):
+        if not items:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self.prefix + key, json.dumps(value), ex=int(self.ttl))
+        pipeline.execute()
+
+
+class FailSafeCache(ClassificationCache):
+    """Wraps a backend so that its failures are logged and become misses"""
+
+    def __init__(self, backend: ClassificationCache):
+        self.backend = backend
+
+    def get_many(self, keys):
+        try:
+            return self.backend.get_many(keys)
+        except Exception as excp:
+            logger.warning(f"Classification cache lookup failed: {excp}")
+            return {}
+
+    def set_many(self, items):
+        try:
+            self.backend.set_many(items)
+        except Exception as excp:
+            logger.warning(f"Classification cache update failed: {excp}")
+
+
+def build_classification_cache(spec: str, ttl: float = DEFAULT_TTL):
+    """Build the cache backend described by a CLASSIFICATION_CACHE value"""
+    if spec == "memory":
+        return MemoryCache(ttl=ttl)
+    if spec.startswith("sqlite:///"):
+        return SQLiteCache(spec[len("sqlite:///") :], ttl=ttl)
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url=spec, ttl=ttl)
+    raise ValueError(f"Unknown classification cache {spec}")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_classification_cache() -> Optional[ClassificationCache]:
+    """Return the cache configured by CLASSIFICATION_CACHE, if any"""
+    spec = current_app.config.get("CLASSIFICATION_CACHE")
+    if not spec:
+        return None
+    ttl = current_app.config.get("CLASSIFICATION_CACHE_TTL", DEFAULT_TTL)
+    with _caches_lock:
+        if (spec, ttl) not in _caches:
+            _caches[(spec, ttl)] = FailSafeCache(build_classification_cache(spec, ttl))
+        return _caches[(spec, ttl)]
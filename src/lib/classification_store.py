@@ -0,0 +1,158 @@
+"""
+Optional persistent store of classification results, backed by SQLite.
+
+Each row records the result for one dataset uuid together with the
+fingerprint of the metadata it was computed from and the content hash of the
+rule chain that computed it. A stored result is only returned when both
+still match, so a changed entity or a reloaded chain invalidates it.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS classifications (
+    uuid TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    chain_hash TEXT NOT NULL,
+    assaytype TEXT,
+    metadata TEXT NOT NULL,
+    result TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS classifications_assaytype
+    ON classifications (assaytype);
+"""
+
+
+def metadata_fingerprint(metadata: dict) -> str:
+    """Return a hash identifying the content of a metadata dict"""
+    canonical = json.dumps(metadata, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ClassificationStore:
+    """
+    SQLite-backed classification results. Safe to share between threads
+    (each gets its own connection) and between processes (WAL journaling).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, uuid: str, fingerprint: str, chain_hash: str) -> Optional[dict]:
+        """Return the stored result, or None if absent or stale.
+
+        An empty dict is a stored "no rule matched" result.
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT result FROM classifications"
+                " WHERE uuid = ? AND fingerprint = ? AND chain_hash = ?",
+                (uuid, fingerprint, chain_hash),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row[0])
+
+    def put(
+        self,
+        uuid: str,
+        fingerprint: str,
+        chain_hash: str,
+        metadata: dict,
+        result: dict,
+    ) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO classifications"
+                " (uuid, fingerprint, chain_hash, assaytype, metadata, result, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    uuid,
+                    fingerprint,
+                    chain_hash,
+                    result.get("assaytype"),
+                    json.dumps(metadata),
+                    json.dumps(result),
+                    time.time(),
+                ),
+            )
+
+    def uuids_for_assaytype(self, assaytype: str, chain_hash: str = None) -> list:
+        """Return the uuids whose stored result has the given assaytype.
+
+        If chain_hash is given, only results computed by that chain count.
+        """
+        query = "SELECT uuid FROM classifications WHERE assaytype = ?"
+        params = [assaytype]
+        if chain_hash:
+            query += " AND chain_hash = ?"
+            params.append(chain_hash)
+        return [row[0] for row in self._connection().execute(query, params)]
+
+    def export(self, chain_hash: str = None) -> Iterator[dict]:
+        """Yield every stored entry, optionally only those from one chain.
+
+        The entries have the "uuid", "metadata" and "result" keys expected by
+        lib.chain_diff.reclassify, plus "fingerprint" and "chain_hash".
+        """
+        query = (
+            "SELECT uuid, fingerprint, chain_hash, metadata, result"
+            " FROM classifications"
+        )
+        params = []
+        if chain_hash:
+            query += " WHERE chain_hash = ?"
+            params.append(chain_hash)
+        for uuid, fingerprint, row_hash, metadata, result in self._connection().execute(
+            query, params
+        ):
+            yield {
+                "uuid": uuid,
+                "fingerprint": fingerprint,
+                "chain_hash": row_hash,
+                "metadata": json.loads(metadata),
+                "result": json.loads(result),
+            }
+
+    def purge_stale(self, chain_hash: str) -> int:
+        """Delete entries computed by any chain other than chain_hash"""
+        with self._connection() as conn:
+            return conn.execute(
+                "DELETE FROM classifications WHERE chain_hash != ?", (chain_hash,)
+            ).rowcount
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_classification_store() -> Optional[ClassificationStore]:
+    """Return the store configured by CLASSIFICATION_STORE_PATH, if any"""
+    from flask import current_app
+
+    db_path = current_app.config.get("CLASSIFICATION_STORE_PATH")
+    if not db_path:
+        return None
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = ClassificationStore(db_path)
+        return _stores[db_path]
@@ -0,0 +1,211 @@
+"""
+Classification without the web service.
+
+A Classifier holds one rule chain, loaded from an explicit source, and
+classifies metadata dicts in-process. It needs neither a Flask app nor the
+entity service: Flask, hubmap_sdk, YAML and schema validation are imported
+only when a feature needing them is used. For example::
+
+    classifier = Classifier("rule_chain.json")
+    classifier.load()
+    info = classifier.classify({"assay_type": "CODEX", ...})
+
+It can also be run from the src directory, reading metadata records as
+NDJSON and writing one result per line::
+
+    python -m lib.classifier RULE_CHAIN [METADATA.ndjson ...]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator, Union
+
+from lib.rule_chain import (
+    EvaluationBudget,
+    NoMatchException,
+    RuleChain,
+    RuleLogicException,
+    build_entity_metadata,
+    chain_from_records,
+    normalize_metadata,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Classifier:
+    """
+    Parameters
+    ----------
+    source : Union[str, Path, bytes]
+        The chain as a file path, a URI (file://, http:// or https://), or
+        the JSON or YAML text of the chain itself as bytes.
+    backend : str, optional
+        The evaluation backend to use.
+    validate : bool
+        Check the chain against the chain schema when loading it. Skipping
+        this avoids importing the schema tools.
+    max_ms, max_rules : optional
+        A budget for each classification, see EvaluationBudget.
+    """
+
+    def __init__(
+        self,
+        source: Union[str, Path, bytes],
+        backend: str = None,
+        validate: bool = True,
+        max_ms: float = None,
+        max_rules: int = None,
+    ):
+        self.source = source
+        self.backend = backend
+        self.validate = validate
+        self.max_ms = max_ms
+        self.max_rules = max_rules
+        self.chain = None
+        self.lock = threading.Lock()
+
+    def read_source(self) -> tuple:
+        """Return (the chain text, its format)"""
+        source = self.source
+        if isinstance(source, bytes):
+            text = source.decode("utf-8")
+        elif isinstance(source, str) and "://" in source:
+            import urllib.request
+
+            with urllib.request.urlopen(source) as f:
+                text = f.read().decode("utf-8")
+        else:
+            text = Path(source).read_text()
+        name = source if isinstance(source, (str, Path)) else ""
+        if str(name).endswith(".json") or text.lstrip().startswith("["):
+            return text, "json"
+        return text, "yaml"
+
+    def load(self) -> RuleChain:
+        """(Re)load the chain from the source, and return it.
+
+        Raises
+        ------
+        RuleSyntaxException
+            If a rule is not well-formed.
+        """
+        text, chain_format = self.read_source()
+        if chain_format == "json":
+            json_recs = json.loads(text)
+        else:
+            import yaml
+
+            json_recs = yaml.safe_load(text)
+        chain = chain_from_records(json_recs, validate=self.validate)
+        with self.lock:
+            self.chain = chain
+        return chain
+
+    @property
+    def content_hash(self) -> str:
+        return self.get_chain().content_hash
+
+    def get_chain(self) -> RuleChain:
+        """The loaded chain, loading it first if need be"""
+        with self.lock:
+            chain = self.chain
+        return chain if chain is not None else self.load()
+
+    def classify(self, metadata: dict) -> dict:
+        """Return the assay information for a metadata dict.
+
+        The dict is not modified.
+
+        Raises
+        ------
+        NoMatchException
+            If no rule matches the metadata.
+        RuleLogicException
+            If a rule fails to evaluate, or the budget is exceeded.
+        """
+        chain = self.get_chain()
+        budget = None
+        if self.max_ms or self.max_rules:
+            budget = EvaluationBudget(self.max_ms, self.max_rules)
+        return chain.apply(normalize_metadata(dict(metadata)), self.backend, budget)
+
+    def classify_entity(self, entity) -> dict:
+        """Return the assay information for an entity, as a dict or
+        hubmap_sdk.Entity as returned by the entity service"""
+        return self.classify(build_entity_metadata(entity))
+
+    def classify_many(self, records: Iterable[dict]) -> Iterator[dict]:
+        """
+        Classify metadata dicts in order, yielding for each a dict with the
+        result, {} if no rule matched, or an "error" message. Records which
+        are not dicts, such as the InvalidRecords of read_ndjson, get an
+        "error" too.
+        """
+        for metadata in records:
+            if isinstance(metadata, InvalidRecord):
+                yield {"error": metadata.message}
+                continue
+            if not isinstance(metadata, dict):
+                yield {"error": "Record must be a JSON object"}
+                continue
+            try:
+                yield self.classify(metadata)
+            except NoMatchException:
+                yield {}
+            except RuleLogicException as excp:
+                yield {"error": f"Error applying classification rules: {excp}"}
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                yield {"error": f"Unexpected error while getting assay type: {e}"}
+
+
+class InvalidRecord:
+    """Stands in for an NDJSON line which could not be parsed"""
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+def read_ndjson(lines: Iterable[Union[str, bytes]]) -> Iterator[dict]:
+    """Parse NDJSON lines, yielding an InvalidRecord for each invalid one"""
+    for line_no, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as excp:
+                yield InvalidRecord(f"Invalid JSON on line {line_no}: {excp}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Classify NDJSON metadata records with a rule chain"
+    )
+    parser.add_argument("rule_chain", help="rule chain path or URI, .json or .yaml")
+    parser.add_argument(
+        "inputs", nargs="*", help="NDJSON metadata files; stdin if none"
+    )
+    parser.add_argument("--backend", help="evaluation backend to use")
+    parser.add_argument(
+        "--no-validate",
+        action="store_true",
+        help="skip checking the chain against the chain schema",
+    )
+    args = parser.parse_args()
+    classifier = Classifier(
+        args.rule_chain, backend=args.backend, validate=not args.no_validate
+    )
+    classifier.load()
+    for path in args.inputs or ["-"]:
+        stream = sys.stdin if path == "-" else open(path)
+        with stream:
+            for rslt in classifier.classify_many(read_ndjson(stream)):
+                sys.stdout.write(json.dumps(rslt) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Offline classification of columnar metadata snapshots.
+
+Reads a Parquet or Arrow IPC file with one metadata record per row and
+writes the classification of each row to a Parquet file with typed result
+columns. Only the columns the rule chain reads (plus an optional id column)
+are loaded, the input is memory-mapped, and rows are processed one record
+batch at a time, so memory use is bounded by the batch size rather than the
+size of the snapshot.
+
+Requires pyarrow. Run from the src directory::
+
+    python -m lib.columnar RULE_CHAIN INPUT OUTPUT [--id-column uuid]
+"""
+
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from lib.rule_chain import (
+    NoMatchException,
+    RuleChain,
+    RuleLoader,
+    RuleLogicException,
+    normalize_metadata,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# The result fields written as typed columns; any others a rule produces are
+# written as JSON in the "other_results" column
+RESULT_COLUMNS = {
+    "assaytype": "string",
+    "dataset-type": "string",
+    "description": "string",
+    "dir-schema": "string",
+    "tbl-schema": "string",
+    "contains-pii": "bool",
+    "primary": "bool",
+    "is-multi-assay": "bool",
+    "vitessce-hints": "list<string>",
+    "must-contain": "list<string>",
+}
+
+ARROW_SUFFIXES = [".arrow", ".feather", ".ipc"]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Columnar classification requires the pyarrow package")
+
+
+def _arrow_type(type_name: str):
+    return {
+        "string": pa.string(),
+        "bool": pa.bool_(),
+        "list<string>": pa.list_(pa.string()),
+    }[type_name]
+
+
+def open_batches(input_path: str, columns: list, batch_size: int) -> tuple:
+    """Open a Parquet or Arrow IPC file for reading in record batches.
+
+    Parameters
+    ----------
+    input_path : str
+        The file to read. Files ending in .arrow, .feather or .ipc are read
+        as Arrow IPC files, anything else as Parquet.
+    columns : list
+        The columns wanted; those absent from the file are ignored.
+    batch_size : int
+        The number of rows per batch. Arrow IPC files are read in the
+        batches they were written with.
+
+    Returns
+    -------
+    tuple
+        (the file's full schema, an iterator over record batches holding
+        only the wanted columns)
+    """
+    _require_pyarrow()
+    if Path(input_path).suffix.lower() in ARROW_SUFFIXES:
+        reader = pa.ipc.open_file(pa.memory_map(input_path))
+        schema = reader.schema
+        wanted = [col for col in columns if col in schema.names]
+
+        def batches():
+            for idx in range(reader.num_record_batches):
+                batch = reader.get_batch(idx)
+                yield pa.RecordBatch.from_arrays(
+                    [batch.column(col) for col in wanted], names=wanted
+                )
+
+        return schema, batches()
+    parquet_file = pq.ParquetFile(input_path, memory_map=True)
+    schema = parquet_file.schema_arrow
+    wanted = [col for col in columns if col in schema.names]
+    return schema, parquet_file.iter_batches(batch_size=batch_size, columns=wanted)
+
+
+def output_schema(id_field=None):
+    """The schema of the output file, led by the input's id column if any"""
+    _require_pyarrow()
+    fields = [id_field] if id_field is not None else []
+    fields.append(pa.field("rule_index", pa.int32()))
+    fields.extend(
+        pa.field(name, _arrow_type(type_name))
+        for name, type_name in RESULT_COLUMNS.items()
+    )
+    fields.append(pa.field("other_results", pa.string()))
+    fields.append(pa.field("error", pa.string()))
+    return pa.schema(fields)
+
+
+def classify_batch(
+    chain: RuleChain, batch, schema, id_column: str = None, backend: str = None
+) -> tuple:
+    """Classify every row of a record batch.
+
+    Returns
+    -------
+    tuple
+        (a record batch of results with the given schema, a dict of
+        "matched", "unmatched" and "errors" counts)
+    """
+    columns = {name: [] for name in schema.names}
+    counts = {"matched": 0, "unmatched": 0, "errors": 0}
+    for row in batch.to_pylist():
+        if id_column is not None:
+            columns[id_column].append(row.get(id_column))
+        metadata = normalize_metadata(
+            {key: val for key, val in row.items() if val is not None}
+        )
+        rule_index, rslt, error = None, {}, None
+        try:
+            rule_index, rslt = chain.evaluate(metadata, backend)
+            counts["matched"] += 1
+        except NoMatchException:
+            counts["unmatched"] += 1
+        except RuleLogicException as excp:
+            error = f"Error applying classification rules: {excp}"
+            counts["errors"] += 1
+        columns["rule_index"].append(rule_index)
+        for name, type_name in RESULT_COLUMNS.items():
+            val = rslt.get(name)
+            if type_name.startswith("list") and val is not None:
+                val = list(val)
+            columns[name].append(val)
+        others = {key: val for key, val in rslt.items() if key not in RESULT_COLUMNS}
+        columns["other_results"].append(json.dumps(others) if others else None)
+        columns["error"].append(error)
+    return pa.RecordBatch.from_pydict(columns, schema=schema), counts
+
+
+def classify_file(
+    chain: RuleChain,
+    input_path: str,
+    output_path: str,
+    id_column: str = None,
+    batch_size: int = 10000,
+    backend: str = None,
+) -> dict:
+    """Classify a columnar metadata snapshot into a Parquet file of results.
+
+    Parameters
+    ----------
+    chain : RuleChain
+        The chain to classify with.
+    input_path : str
+        A Parquet or Arrow IPC file with one metadata record per row.
+    output_path : str
+        The Parquet file to write, one row per input row in the same order.
+    id_column : str, optional
+        An input column, e.g. "uuid", to copy to the output.
+    batch_size : int
+        The number of rows to read and classify at a time.
+    backend : str, optional
+        The evaluation backend to use.
+
+    Returns
+    -------
+    dict
+        Row counts and the elapsed time.
+    """
+    _require_pyarrow()
+    start = time.perf_counter()
+    columns = sorted(chain.referenced_symbols() | ({id_column} - {None}))
+    input_schema, batches = open_batches(input_path, columns, batch_size)
+    if id_column is not None and id_column not in input_schema.names:
+        raise KeyError(f"Input has no column {id_column}")
+    schema = output_schema(
+        input_schema.field(id_column) if id_column is not None else None
+    )
+    stats = {"rows": 0, "matched": 0, "unmatched": 0, "errors": 0}
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in batches:
+            rslt_batch, counts = classify_batch(
+                chain, batch, schema, id_column, backend
+            )
+            writer.write_batch(rslt_batch)
+            stats["rows"] += batch.num_rows
+            for key, count in counts.items():
+                stats[key] += count
+    stats["columns_read"] = [col for col in columns if col in input_schema.names]
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Classify a Parquet or Arrow snapshot of dataset metadata"
+    )
+    parser.add_argument("rule_chain", help="rule chain file, .json or .yaml")
+    parser.add_argument("input", help="Parquet or Arrow IPC metadata snapshot")
+    parser.add_argument("output", help="Parquet file of results to write")
+    parser.add_argument("--id-column", help="input column to copy to the output")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--backend", help="evaluation backend to use")
+    args = parser.parse_args()
+    chain_format = "json" if args.rule_chain.endswith(".json") else "yaml"
+    with open(args.rule_chain) as f:
+        chain = RuleLoader(f, format=chain_format).load()
+    stats = classify_file(
+        chain,
+        args.input,
+        args.output,
+        id_column=args.id_column,
+        batch_size=args.batch_size,
+        backend=args.backend,
+    )
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
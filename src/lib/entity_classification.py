@@ -0,0 +1,68 @@
+"""
+Classification of an entity by uuid, as served by ``GET /assaytype/<uuid>``
+and done by the warm-up, going through the classification cache if one is
+configured.
+"""
+
+from typing import Optional
+
+from werkzeug.datastructures import ETags
+
+from lib.classification_cache import get_classification_cache, uuid_cache_key
+from lib.etags import classification_etag
+from lib.rule_chain import (
+    NoMatchException,
+    build_entity_metadata,
+    calculate_assay_info,
+    get_rule_chain,
+)
+from lib.services import get_entity
+from lib.stage_timing import stage
+
+
+def classify_uuid(
+    ds_uuid: str,
+    token: Optional[str],
+    chain_selector: Optional[str],
+    if_none_match: Optional[ETags] = None,
+) -> tuple:
+    """
+    Return (the entity's assay info, its entity tag). The assay info is {}
+    if no rule matched, and None if the tag is one of if_none_match, in which
+    case the chain is not applied.
+    """
+    # Only the request which leads a coalesced lookup records these stages
+    if_none_match = if_none_match or ETags()
+    chain = get_rule_chain(chain_selector)
+    cache = get_classification_cache()
+    if cache is not None:
+        cache_key = uuid_cache_key(chain.result_hash, ds_uuid, token)
+        with stage("cache_get"):
+            cached = cache.get(cache_key)
+        if cached is not None and "etag" in cached:
+            if if_none_match.contains(cached["etag"]):
+                return None, cached["etag"]
+            return cached["result"], cached["etag"]
+    with stage("get_entity"):
+        entity = get_entity(ds_uuid, token)
+    with stage("build_entity_metadata"):
+        metadata = build_entity_metadata(entity)
+    with stage("etag"):
+        etag = classification_etag(chain, entity, metadata)
+    if if_none_match.contains(etag):
+        return None, etag
+    with stage("calculate_assay_info"):
+        try:
+            rslt = calculate_assay_info(metadata, chain_selector, uuid=ds_uuid)
+        except NoMatchException:
+            rslt = {}
+    # Skip caching if a reload replaced the chain, or a rule was disabled,
+    # meanwhile
+    if (
+        cache is not None
+        and get_rule_chain(chain_selector) is chain
+        and uuid_cache_key(chain.result_hash, ds_uuid, token) == cache_key
+    ):
+        with stage("cache_set"):
+            cache.set(cache_key, {"result": rslt, "etag": etag})
+    return rslt, etag
@@ -0,0 +1,73 @@
+"""
+Entity tags for conditional GETs of classification results.
+
+The tag of a result is a hash of the entity's last-modified timestamp, the
+content hash of the chain which classified it, and the part of the entity's
+metadata the chain reads. A client which sends the tag back in
+``If-None-Match`` gets a 304 without the chain being applied again.
+
+Results depend on the caller's token, so responses are marked private. The
+``Cache-Control`` value can be changed with ``CLASSIFICATION_CACHE_CONTROL``.
+"""
+
+import hashlib
+from typing import Union
+
+from flask import Response, current_app
+from hubmap_sdk import Entity
+
+from lib.classification_store import metadata_fingerprint
+from lib.rule_chain import RuleChain, normalize_metadata
+
+DEFAULT_CACHE_CONTROL = "private, no-cache"
+
+
+def last_modified_timestamp(entity: Union[Entity, dict]):
+    if isinstance(entity, dict):
+        return entity.get("last_modified_timestamp")
+    return getattr(entity, "last_modified_timestamp", None)
+
+
+def make_etag(*parts) -> str:
+    """Hash the parts into an (unquoted) strong entity tag"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(f"{part}\0".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def classification_etag(
+    chain: RuleChain, entity: Union[Entity, dict], metadata: dict
+) -> str:
+    """The tag of the result of classifying an entity's metadata with a chain.
+
+    Only the metadata the chain reads is hashed, so changes to other fields
+    do not change the tag.
+    """
+    symbols = chain.referenced_symbols()
+    projected = normalize_metadata(
+        {key: val for key, val in metadata.items() if key in symbols}
+    )
+    return make_etag(
+        last_modified_timestamp(entity),
+        chain.result_hash,
+        metadata_fingerprint(projected),
+    )
+
+
+def metadata_etag(entity: Union[Entity, dict], metadata: dict) -> str:
+    """The tag of the metadata built for an entity"""
+    return make_etag(last_modified_timestamp(entity), metadata_fingerprint(metadata))
+
+
+def add_validators(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = current_app.config.get(
+        "CLASSIFICATION_CACHE_CONTROL", DEFAULT_CACHE_CONTROL
+    )
+    return response
+
+
+def not_modified(etag: str) -> Response:
+    """A 304 response for a client which already holds the tagged result"""
+    return add_validators(Response(status=304), etag)
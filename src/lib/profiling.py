@@ -0,0 +1,157 @@
+"""
+On-demand profiling of single live requests.
+
+When ``PROFILING_ENABLED`` is set, a data admin can add ``?profile=<mode>``
+or an ``X-Profile: <mode>`` header to a request to the blueprint. The request
+is handled as usual, but under a profiler, and the response is replaced by
+the profile as a download; the status the handler returned is in the
+``X-Profiled-Status`` header. The modes are:
+
+``cprofile``
+    A deterministic profile of the handler thread, as a pstats file which
+    can be read with ``python -m pstats`` or snakeviz.
+``stacks``
+    The handler thread's stack sampled every ``PROFILING_SAMPLE_INTERVAL_MS``
+    (default 1), as collapsed stacks for flamegraph.pl or speedscope.
+
+Setting ``PROFILING_REQUIRE_ADMIN`` to false lets any caller profile, which
+is only meant for local development. With profiling disabled, requests are
+handled as if the parameter and header were absent.
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, Response, current_app, g, request
+
+from lib.auth import is_data_admin
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("cprofile", "stacks")
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """The samples in the collapsed stack format, one stack per line"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.items())
+
+
+def install_profiling(blueprint: Blueprint):
+    """Let admins profile requests routed to the blueprint"""
+    blueprint.before_request(_start_profile)
+    blueprint.after_request(_finish_profile)
+    blueprint.teardown_request(_stop_profiler)
+
+
+def requested_profile_mode():
+    mode = request.args.get("profile") or request.headers.get("X-Profile")
+    return mode.lower() if mode else None
+
+
+def is_profiling_allowed() -> bool:
+    if not current_app.config.get("PROFILING_REQUIRE_ADMIN", True):
+        return True
+    return is_data_admin()
+
+
+def _start_profile():
+    if not current_app.config.get("PROFILING_ENABLED"):
+        return None
+    mode = requested_profile_mode()
+    if mode is None:
+        return None
+    if mode not in PROFILE_MODES:
+        return Response(
+            f"Unknown profile mode {mode}; use one of {', '.join(PROFILE_MODES)}",
+            400,
+        )
+    if not is_profiling_allowed():
+        return Response("Profiling requests requires data admin privileges", 403)
+    g.profile_mode = mode
+    g.profile_start = time.perf_counter()
+    if mode == "cprofile":
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    else:
+        interval = current_app.config.get("PROFILING_SAMPLE_INTERVAL_MS", 1) / 1000
+        g.profiler = StackSampler(threading.get_ident(), interval)
+        g.profiler.start()
+    return None
+
+
+def _stop_profiler(exc=None):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    else:
+        profiler.stop()
+    return profiler
+
+
+def _finish_profile(response):
+    if "profile_mode" not in g:
+        return response
+    if response.is_streamed:
+        # Generate the body now, so the profile covers producing it
+        response.get_data()
+    profiler = _stop_profiler()
+    if profiler is None:
+        return response
+    elapsed_ms = 1000 * (time.perf_counter() - g.profile_start)
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    if g.profile_mode == "cprofile":
+        profiler.create_stats()
+        # The format pstats.Stats reads, as written by Profile.dump_stats
+        profile = Response(marshal.dumps(profiler.stats), 200)
+        profile.mimetype = "application/octet-stream"
+        filename = f"profile-{stamp}.prof"
+    else:
+        profile = Response(profiler.collapsed(), 200, mimetype="text/plain")
+        filename = f"profile-{stamp}.collapsed"
+    profile.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    profile.headers["X-Profiled-Status"] = str(response.status_code)
+    profile.headers["X-Profiled-Duration-Ms"] = f"{elapsed_ms:.2f}"
+    logger.info(
+        f"Profiled {request.method} {request.path} ({g.profile_mode}):"
+        f" {response.status_code} in {elapsed_ms:.2f} ms"
+    )
+    return profile
@@ -0,0 +1,459 @@
+"""
+Helpers for walking and rewriting the rule_engine ASTs held by a RuleChain.
+
+rule_engine does not offer a visitor API, so these work generically off the
+attributes each node carries (``__slots__`` plus any ``__dict__``).
+"""
+
+import re
+import sys
+import threading
+from decimal import Decimal
+from types import ModuleType
+
+from rule_engine import Context
+from rule_engine.ast import (
+    ArrayExpression,
+    ComparisonExpression,
+    ComprehensionExpression,
+    ContainsExpression,
+    ExpressionBase,
+    FuzzyComparisonExpression,
+    GetItemExpression,
+    LiteralExpressionBase,
+    LogicExpression,
+    MappingExpression,
+    StringExpression,
+    SymbolExpression,
+    UnaryExpression,
+)
+
+# Node attributes which are not part of the expression structure
+NON_STRUCTURAL_ATTRS = {"context", "result_type", "_evaluator"}
+
+SCALAR_TYPES = (str, bool, int, float, Decimal, type(None))
+
+
+def node_attrs(node):
+    """Return the names of the attributes holding state on an AST node"""
+    names = []
+    for cls in type(node).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(slots)
+    names.extend(getattr(node, "__dict__", {}))
+    return [
+        name
+        for name in dict.fromkeys(names)
+        if name not in NON_STRUCTURAL_ATTRS and hasattr(node, name)
+    ]
+
+
+def iter_child_nodes(node):
+    """Yield the expression nodes directly below the given node"""
+    for name in node_attrs(node):
+        yield from _iter_nodes_in(getattr(node, name))
+
+
+def _iter_nodes_in(val):
+    if isinstance(val, ExpressionBase):
+        yield val
+    elif isinstance(val, (tuple, list, set, frozenset)):
+        for elt in val:
+            yield from _iter_nodes_in(elt)
+
+
+def iter_nodes(node):
+    """Yield the given node and every expression node below it, depth first"""
+    yield node
+    for child in iter_child_nodes(node):
+        yield from iter_nodes(child)
+
+
+def referenced_symbols(node, bound=frozenset()):
+    """
+    Return the names of the symbols an expression reads from its input.
+    Names bound by an enclosing comprehension, given in bound, are not read
+    from the input.
+    """
+    if isinstance(node, SymbolExpression):
+        return {node.name} if node.scope is None and node.name not in bound else set()
+    if isinstance(node, ComprehensionExpression):
+        names = referenced_symbols(node.iterable, bound)
+        inner = bound | {node.variable}
+        for child in (node.result, node.condition):
+            if child is not None:
+                names |= referenced_symbols(child, inner)
+        return names
+    names = set()
+    for child in iter_child_nodes(node):
+        names |= referenced_symbols(child, bound)
+    return names
+
+
+def mapping_literal_keys(node):
+    """
+    Return the keys of a mapping literal like ``{'a': x, 'b': 1}`` whose keys
+    are all string literals, or None for any other expression.
+    """
+    if isinstance(node, MappingExpression) and all(
+        isinstance(key, StringExpression) for key, _ in node.value
+    ):
+        return {key.value for key, _ in node.value}
+    return None
+
+
+def iter_conjuncts(node):
+    """Yield the operands of a chain of ``and`` expressions, left to right"""
+    if isinstance(node, LogicExpression) and node.type == "and":
+        yield from iter_conjuncts(node.left)
+        yield from iter_conjuncts(node.right)
+    else:
+        yield node
+
+
+def is_scalar_literal(node):
+    """True if node is a literal string, number, boolean or null"""
+    return isinstance(node, LiteralExpressionBase) and isinstance(
+        node.value, SCALAR_TYPES
+    )
+
+
+def subject_symbol(node):
+    """
+    Return the symbol name tested by an expression like ``x`` or ``x[0]``,
+    or None for anything else.
+    """
+    if isinstance(node, GetItemExpression):
+        node = node.container
+    if isinstance(node, SymbolExpression) and node.scope is None:
+        return node.name
+    return None
+
+
+def literal_constraint(node):
+    """
+    Recognize the equality and membership tests used by generated chains,
+    ``x == 'a'`` and ``x in ['a', 'b']`` (or ``x[0] in [...]``).
+
+    Returns
+    -------
+    tuple or None
+        (symbol name, list of literal values) or None if node is not a test
+        of that form.
+    """
+    if isinstance(node, ComparisonExpression) and node.type == "eq":
+        for subject, other in [(node.left, node.right), (node.right, node.left)]:
+            symbol = subject_symbol(subject)
+            if symbol and is_scalar_literal(other):
+                return symbol, [other.value]
+    elif isinstance(node, ContainsExpression) and isinstance(
+        node.container, ArrayExpression
+    ):
+        symbol = subject_symbol(node.member)
+        if symbol and all(is_scalar_literal(elt) for elt in node.container.value):
+            return symbol, [elt.value for elt in node.container.value]
+    return None
+
+
+def regex_subjects(node, bound=None):
+    """
+    Return the record attributes whose values an expression matches against
+    regular expressions: ``x`` in ``x =~ 'a.*'`` or ``x[0] =~~ 'a'``, and in
+    ``[elt for elt in x if elt =~ 'a.*']``. bound maps the variables of
+    enclosing comprehensions to the attributes they iterate over, or None.
+    """
+    bound = {} if bound is None else bound
+
+    def resolve(symbol):
+        return bound.get(symbol) if symbol in bound else symbol
+
+    if isinstance(node, ComprehensionExpression):
+        names = regex_subjects(node.iterable, bound)
+        iterated = subject_symbol(node.iterable)
+        inner = dict(bound)
+        inner[node.variable] = resolve(iterated) if iterated else None
+        for child in (node.result, node.condition):
+            if child is not None:
+                names |= regex_subjects(child, inner)
+        return names
+    names = set()
+    if isinstance(node, FuzzyComparisonExpression):
+        for operand in (node.left, node.right):
+            symbol = subject_symbol(operand)
+            if symbol and resolve(symbol):
+                names.add(resolve(symbol))
+    for child in iter_child_nodes(node):
+        names |= regex_subjects(child, bound)
+    return names
+
+
+def is_total(node):
+    """
+    True if evaluating node can never raise, whatever the record holds.
+    Conservative: only the forms generated chains use are recognized.
+    """
+    if isinstance(node, SymbolExpression):
+        return True
+    if isinstance(node, LiteralExpressionBase):
+        return is_scalar_literal(node)
+    if isinstance(node, LogicExpression):
+        return is_total(node.left) and is_total(node.right)
+    if isinstance(node, UnaryExpression) and node.type == "not":
+        return is_total(node.right)
+    if isinstance(node, ComparisonExpression) and node.type in ("eq", "ne"):
+        return is_total(node.left) and is_total(node.right)
+    if isinstance(node, ContainsExpression):
+        return (
+            isinstance(node.container, ArrayExpression)
+            and all(is_total(elt) for elt in node.container.value)
+            and is_total(node.member)
+        )
+    return False
+
+
+def required_symbols(node):
+    """
+    Return the symbols which must be non-null for node to be truthy.
+
+    If any of them is null or missing, node is certain to evaluate to a
+    falsy value without raising, so a rule with this condition can be
+    skipped without changing the outcome, errors included.
+    """
+    if isinstance(node, SymbolExpression):
+        return {node.name} if node.scope is None else set()
+    if isinstance(node, LogicExpression):
+        left = required_symbols(node.left)
+        right = required_symbols(node.right)
+        if node.type == "or":
+            return left & right
+        # The right side is only reached if the left is truthy, so its
+        # requirements only count if the left cannot raise first
+        return left | right if is_total(node.left) else left
+    if isinstance(node, ComparisonExpression) and node.type == "eq":
+        for subject, other in [(node.left, node.right), (node.right, node.left)]:
+            if (
+                isinstance(subject, SymbolExpression)
+                and subject.scope is None
+                and is_scalar_literal(other)
+                and other.value is not None
+            ):
+                return {subject.name}
+    elif isinstance(node, FuzzyComparisonExpression) and node.type == "eq_fzs":
+        if (
+            isinstance(node.left, SymbolExpression)
+            and node.left.scope is None
+            and isinstance(node.right, StringExpression)
+        ):
+            return {node.left.name}
+    elif isinstance(node, ContainsExpression):
+        member = node.member
+        if (
+            isinstance(member, SymbolExpression)
+            and member.scope is None
+            and isinstance(node.container, ArrayExpression)
+            and all(
+                is_scalar_literal(elt) and elt.value is not None
+                for elt in node.container.value
+            )
+        ):
+            return {member.name}
+    return set()
+
+
+class SetContainsExpression(ContainsExpression):
+    """
+    ``x in [literals]`` evaluated as a hashed lookup. Python's equal values
+    hash equally, so this gives the same answer as scanning the tuple, which
+    is still done for unhashable members such as arrays.
+    """
+
+    __slots__ = ("members", "values")
+
+    @classmethod
+    def from_contains(cls, node):
+        new_node = cls(node.context, node.container, node.member)
+        new_node.values = tuple(elt.value for elt in node.container.value)
+        new_node.members = frozenset(new_node.values)
+        return new_node
+
+    def evaluate(self, thing):
+        member_value = self.member.evaluate(thing)
+        try:
+            return member_value in self.members
+        except TypeError:
+            return member_value in self.values
+
+
+def rewrite_membership(node, memo=None):
+    """
+    Replace every ``x in [literals]`` test under node with the equivalent
+    SetContainsExpression, in place, returning the node to use for node
+    itself. memo maps the ids of nodes already visited to their replacements
+    so shared subtrees are rewritten once.
+    """
+    memo = {} if memo is None else memo
+    if id(node) in memo:
+        return memo[id(node)][1]
+    for name in node_attrs(node):
+        val = getattr(node, name)
+        if isinstance(val, ExpressionBase):
+            new_val = rewrite_membership(val, memo)
+            if new_val is not val:
+                setattr(node, name, new_val)
+        elif isinstance(val, tuple):
+            new_val = tuple(
+                (
+                    rewrite_membership(elt, memo)
+                    if isinstance(elt, ExpressionBase)
+                    else elt
+                )
+                for elt in val
+            )
+            if any(new is not old for new, old in zip(new_val, val)):
+                setattr(node, name, new_val)
+    new_node = node
+    if (
+        type(node) is ContainsExpression
+        and isinstance(node.container, ArrayExpression)
+        and all(is_scalar_literal(elt) for elt in node.container.value)
+    ):
+        new_node = SetContainsExpression.from_contains(node)
+    # Holding the node keeps its id from being reused while memo is alive
+    memo[id(node)] = (node, new_node)
+    return new_node
+
+
+def and_prefixes(node):
+    """
+    Return the leading sub-conjunctions of a chain of ``and`` expressions,
+    longest first: for ``a and b and c`` (parsed as ``(a and b) and c``),
+    ``a and b`` then ``a``. Each comes with the list of conjuncts which
+    follow it.
+    """
+    prefixes = []
+    rest = []
+    while isinstance(node, LogicExpression) and node.type == "and":
+        rest.insert(0, node.right)
+        node = node.left
+        prefixes.append((node, list(rest)))
+    return prefixes
+
+
+def conjoin(context, conjuncts):
+    """Build the left-associated ``and`` of the given expressions"""
+    node = conjuncts[0]
+    for conjunct in conjuncts[1:]:
+        node = LogicExpression(context, "and", node, conjunct)
+    return node
+
+
+def _value_key(val, memo):
+    if isinstance(val, ExpressionBase):
+        return node_key(val, memo)
+    elif isinstance(val, (tuple, list)):
+        return (type(val).__name__,) + tuple(_value_key(elt, memo) for elt in val)
+    elif isinstance(val, (set, frozenset)):
+        return (type(val).__name__,) + tuple(
+            sorted((_value_key(elt, memo) for elt in val), key=repr)
+        )
+    elif isinstance(val, SCALAR_TYPES):
+        return (type(val).__name__, repr(val))
+    elif isinstance(val, re.Pattern):
+        return ("pattern", val.pattern, val.flags)
+    else:
+        # Nothing is known about this value, so only identical objects match
+        return ("object", id(val))
+
+
+def node_key(node, memo=None):
+    """
+    Return a hashable key which is equal for structurally identical nodes.
+    Nodes only compare equal if they also share a rule_engine Context.
+    """
+    if memo is not None and id(node) in memo:
+        memo_node, key = memo[id(node)]
+        if memo_node is node:
+            return key
+    key = (type(node), id(getattr(node, "context", None))) + tuple(
+        (name, _value_key(getattr(node, name), memo)) for name in node_attrs(node)
+    )
+    if memo is not None:
+        # Holding the node keeps its id from being reused while memo is alive
+        memo[id(node)] = (node, key)
+    return key
+
+
+def _compact_value(val, canon, key_memo):
+    if isinstance(val, ExpressionBase):
+        return compact_expression(val, canon, key_memo)
+    elif isinstance(val, tuple):
+        return tuple(_compact_value(elt, canon, key_memo) for elt in val)
+    elif isinstance(val, list):
+        return [_compact_value(elt, canon, key_memo) for elt in val]
+    elif isinstance(val, str):
+        return sys.intern(val)
+    return val
+
+
+def compact_expression(node, canon, key_memo=None):
+    """
+    Intern the strings in an expression tree and replace each sub-expression
+    with the first structurally identical one seen, so shared fragments like
+    ``not_dcwg and not_derived`` exist once across the whole chain.
+
+    Parameters
+    ----------
+    node : rule_engine.ast.ExpressionBase
+        The root of the expression to compact. It may be modified in place.
+    canon : dict
+        Maps node keys to canonical nodes; share it across all expressions
+        which should be deduplicated against each other.
+    key_memo : dict, optional
+        Cache of node keys, shared across calls for speed.
+
+    Returns
+    -------
+    rule_engine.ast.ExpressionBase
+        The canonical node to use in place of the one passed in.
+    """
+    key_memo = {} if key_memo is None else key_memo
+    for name in node_attrs(node):
+        val = getattr(node, name)
+        new_val = _compact_value(val, canon, key_memo)
+        if new_val is not val:
+            setattr(node, name, new_val)
+    return canon.setdefault(node_key(node, key_memo), node)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Estimate the bytes held by obj and everything it references, counting
+    each object once. Classes, functions and rule_engine Contexts are shared
+    infrastructure and are not counted.
+    """
+    seen = set() if seen is None else seen
+    if (
+        id(obj) in seen
+        or isinstance(obj, (type, ModuleType, Context, threading.local))
+        or callable(obj)
+    ):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(val, seen)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        for elt in obj:
+            size += deep_sizeof(elt, seen)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_sizeof(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__", ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if name != "__dict__" and hasattr(obj, name):
+                    size += deep_sizeof(getattr(obj, name), seen)
+    return size
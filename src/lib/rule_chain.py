@@ -1,14 +1,38 @@
+import decimal
+import hashlib
 import json
 import logging
-import urllib.request
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
-import yaml
-from flask import current_app
-from hubmap_commons.schema_tools import check_json_matches_schema
-from hubmap_sdk import Entity
-from rule_engine import Context, EngineError, Rule
+from rule_engine import Context, EngineError, Rule, SymbolResolutionError
+
+from lib.chain_stamp import get_chain_stamp
+from lib.classification_store import get_classification_store, metadata_fingerprint
+from lib.rule_ast import (
+    and_prefixes,
+    compact_expression,
+    conjoin,
+    deep_sizeof,
+    iter_nodes,
+    mapping_literal_keys,
+    node_key,
+    referenced_symbols,
+    regex_subjects,
+    required_symbols,
+    rewrite_membership,
+)
+from lib.rule_costs import RuleCostMonitor
+from lib.shadow import shadow_monitor
+
+if TYPE_CHECKING:
+    from hubmap_sdk import Entity
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -17,50 +41,345 @@ SCHEMA_BASE_URI = "http://schemata.hubmapconsortium.org/"
 
 
 rule_chain = None
+_seen_stamp_generation = None
+_sync_lock = threading.Lock()
+
+
+def app_config():
+    """The config of the current Flask app. Flask is only imported when it is
+    first needed, so the chain classes can be used without it."""
+    from flask import current_app
 
+    return current_app.config
 
-def initialize_rule_chain():
-    """Initialize the rule chain from the source URI.
+
+def initialize_rule_chain(publish: bool = False):
+    """Initialize the rule chain.
+
+    If another worker of the host has published a chain from the same source,
+    see activate_rule_chain, that chain is adopted, so a worker starting after
+    a reload or patch serves the same chain as the others. Otherwise the
+    chain is loaded from ``RULE_CHAIN_URI``. Either way it is registered in
+    ``rule_chain_registry`` and becomes the active chain.
+
+    Parameters
+    ----------
+    publish : bool
+        Load the chain from ``RULE_CHAIN_URI`` even if one is published, and
+        publish it to the other workers. This is for explicit reloads only.
 
     Raises
     ------
     RuleSyntaxException
         If the JSON rules are not well-formed.
     """
-    global rule_chain
-    rule_src_uri = current_app.config["RULE_CHAIN_URI"]
+    config = app_config()
+    rule_chain_registry.max_size = config.get(
+        "RULE_CHAIN_REGISTRY_SIZE", rule_chain_registry.max_size
+    )
+    if not publish:
+        try:
+            if _adopt_published_rule_chain():
+                return
+        except Exception as excp:
+            logger.warning(f"Could not load the published rule chain: {excp}")
+    new_chain = load_rule_chain(config["RULE_CHAIN_URI"])
+    activate_rule_chain(new_chain, config.get("RULE_CHAIN_VERSION"), publish=publish)
+
+
+def _adopt_published_rule_chain() -> bool:
+    """Make the chain the host's workers have published active, if there is
+    one, returning whether it is active"""
+    shared_dir = app_config().get("RULE_CHAIN_SHARED_DIR")
+    if not shared_dir:
+        return False
+    current = get_chain_stamp(shared_dir).read()
+    if current is None or current[3] != chain_source_id():
+        return False
+    sync_shared_rule_chain()
+    return rule_chain is not None and rule_chain.content_hash == current[1]
+
+
+def activate_rule_chain(chain: "RuleChain", version: str = None, publish=True):
+    """Make a chain the active one in this process.
+
+    If ``RULE_CHAIN_SHARED_DIR`` is configured and publish is True, the
+    chain is also published there for the host's other workers, which pick
+    it up on their next request; see sync_shared_rule_chain. A published
+    chain outlives the workers, so it is tagged with chain_source_id(), and
+    workers configured with a different source ignore it.
+    """
+    global rule_chain, _seen_stamp_generation
+    rule_chain_registry.add(chain, version=version, activate=True)
+    rule_chain = chain
+    shared_dir = app_config().get("RULE_CHAIN_SHARED_DIR")
+    if publish and shared_dir:
+        stamp = get_chain_stamp(shared_dir)
+        stamp.write_artifact(
+            chain.content_hash, [elt.to_record() for elt in chain.links]
+        )
+        _seen_stamp_generation = stamp.write(
+            chain.content_hash, version, chain_source_id()
+        )
+        stamp.prune_artifacts(keep=chain.content_hash)
+
+
+def chain_source_id() -> str:
+    """
+    Identify the source of the chain this process is configured with: the
+    ``RULE_CHAIN_URI``, and the ``RULE_CHAIN_DEPLOY_ID`` if one is set. Set a
+    deploy id, e.g. a build number, to ignore chains published by an earlier
+    deploy of the same URI.
+    """
+    config = app_config()
+    uri, deploy_id = config.get("RULE_CHAIN_URI"), config.get("RULE_CHAIN_DEPLOY_ID")
+    source = f"{uri}\0{deploy_id or ''}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def sync_shared_rule_chain() -> bool:
+    """Switch to the chain last published by another worker, if it changed.
+
+    Meant to run before every request: unless the stamp in
+    ``RULE_CHAIN_SHARED_DIR`` has changed, this only reads a few bytes of
+    memory. A new chain is built from the published records, which were
+    validated by the publishing worker, without fetching the source again.
+    Chains published for another source, see chain_source_id, are ignored.
+
+    Returns
+    -------
+    bool
+        True if a different chain became active.
+    """
+    global _seen_stamp_generation
+    shared_dir = app_config().get("RULE_CHAIN_SHARED_DIR")
+    if not shared_dir:
+        return False
+    stamp = get_chain_stamp(shared_dir)
+    current = stamp.read()
+    if current is None or current[0] == _seen_stamp_generation:
+        return False
+    with _sync_lock:
+        if current[0] == _seen_stamp_generation:
+            return False
+        generation, content_hash, version, source = current
+        if source != chain_source_id():
+            _seen_stamp_generation = generation
+            return False
+        switched = rule_chain is None or rule_chain.content_hash != content_hash
+        if switched:
+            chain = rule_chain_registry.get(content_hash)
+            if chain is None:
+                chain = chain_from_records(
+                    stamp.read_artifact(content_hash), validate=False
+                )
+            activate_rule_chain(chain, version, publish=False)
+            logger.info(f"Switched to published rule chain {content_hash}")
+        _seen_stamp_generation = generation
+        return switched
+
+
+def load_rule_chain(rule_src_uri: str) -> "RuleChain":
+    """Load a rule chain from the given URI.
+
+    Parameters
+    ----------
+    rule_src_uri : str
+        The URI of the chain's JSON or YAML source.
+
+    Returns
+    -------
+    RuleChain
+        The loaded rule chain.
+
+    Raises
+    ------
+    RuleSyntaxException
+        If the JSON rules are not well-formed.
+    """
+    import urllib.request
+
     try:
         json_rules = urllib.request.urlopen(rule_src_uri)
     except json.decoder.JSONDecodeError as excp:
         raise RuleSyntaxException(excp) from excp
-    rule_chain = RuleLoader(json_rules).load()
+    return RuleLoader(json_rules).load()
+
+
+def get_rule_chain(selector: str = None) -> "RuleChain":
+    """Get a rule chain by version or content hash.
+
+    Chains not yet loaded are fetched from the URI given for that version in
+    the ``RULE_CHAIN_VERSION_URIS`` config mapping, and kept in
+    ``rule_chain_registry`` for later requests.
+
+    Parameters
+    ----------
+    selector : str, optional
+        A version name or content hash. If None, the active chain is returned.
+
+    Returns
+    -------
+    RuleChain
+        The selected rule chain.
+
+    Raises
+    ------
+    UnknownRuleChainException
+        If no chain matches the selector.
+    """
+    if not selector:
+        if not rule_chain:
+            initialize_rule_chain()
+        return rule_chain
+    chain = rule_chain_registry.get(selector)
+    if chain is None:
+        version_uris = app_config().get("RULE_CHAIN_VERSION_URIS", {})
+        if selector not in version_uris:
+            raise UnknownRuleChainException(f"Unknown rule chain {selector}")
+        chain = load_rule_chain(version_uris[selector])
+        rule_chain_registry.add(chain, version=selector)
+    return chain
+
+
+def patch_rule_chain(
+    operations: list, selector: str = None, version: str = None
+) -> tuple:
+    """Apply a patch to a registered chain and make the result active.
+
+    Other workers of the host pick the new chain up if it is published,
+    see activate_rule_chain.
+
+    Parameters
+    ----------
+    operations : list
+        Patch operations, as taken by RuleChain.patched().
+    selector : str, optional
+        The version or content hash of the chain to patch; by default the
+        active chain.
+    version : str, optional
+        A version name to register the patched chain under.
+
+    Returns
+    -------
+    tuple
+        (the chain which was patched, the new chain)
+    """
+    old_chain = get_rule_chain(selector)
+    new_chain = old_chain.patched(operations)
+    activate_rule_chain(new_chain, version)
+    logger.info(
+        f"Patched rule chain {old_chain.content_hash} with"
+        f" {len(operations)} operations, giving {new_chain.content_hash}"
+    )
+    return old_chain, new_chain
 
 
-def calculate_assay_info(metadata: dict) -> dict:
+def calculate_assay_info(
+    metadata: dict, chain_selector: str = None, uuid: str = None
+) -> dict:
     """Calculate the assay information for the given metadata.
 
+    If a classification store is configured and the uuid of the entity is
+    given, results of the active chain are looked up in and saved to it.
+
     Parameters
     ----------
     metadata : dict
         The metadata for the entity.
+    chain_selector : str, optional
+        The version or content hash of the rule chain to use. If None, the
+        active chain is used.
+    uuid : str, optional
+        The uuid of the entity the metadata belongs to.
 
     Returns
     -------
     dict
         The assay information for the entity.
     """
-    if not rule_chain:
-        initialize_rule_chain()
+    chain = get_rule_chain(chain_selector)
+    metadata = normalize_metadata(metadata)
+    store = get_classification_store() if uuid and not chain_selector else None
+    if store is None:
+        rslt = apply_rule_chain(chain, metadata)
+        # TODO: check that rslt has the expected parts
+        return rslt
+    fingerprint = metadata_fingerprint(metadata)
+    rslt = store.get(uuid, fingerprint, chain.result_hash)
+    if rslt is None:
+        try:
+            rslt = apply_rule_chain(chain, metadata)
+        except NoMatchException:
+            rslt = {}
+        store.put(uuid, fingerprint, chain.result_hash, metadata, rslt)
+    if not rslt:
+        raise NoMatchException(f"No rule matched record {metadata}")
+    return rslt
+
+
+def apply_rule_chain(chain: "RuleChain", metadata: dict) -> dict:
+    """Apply a chain to normalized metadata with the configured backend.
+
+    The backend is chosen by ``RULE_CHAIN_BACKEND``. If
+    ``RULE_CHAIN_SHADOW_BACKEND`` is set, a ``RULE_CHAIN_SHADOW_RATE``
+    fraction of calls is also run through that backend and compared, see
+    lib.shadow; the result returned is always the configured backend's.
+
+    Each call may evaluate rules for at most ``RULE_EVALUATION_BUDGET_MS``
+    and evaluate at most ``RULE_EVALUATION_MAX_RULES`` rules, and no rule is
+    evaluated which would match a regex against a string longer than
+    ``RULE_EVALUATION_MAX_REGEX_INPUT`` characters. If
+    ``RULE_COST_THRESHOLD_MS`` is set, rule latencies are tracked, and rules
+    exceeding it ``RULE_COST_TRIP_COUNT`` times are flagged, and disabled if
+    ``RULE_COST_DISABLE`` is set; see lib.rule_costs.
+    """
+    config = app_config()
+    if config.get("RULE_COST_THRESHOLD_MS") and chain.cost_monitor is None:
+        chain.cost_monitor = RuleCostMonitor(
+            chain,
+            config["RULE_COST_THRESHOLD_MS"],
+            trip_count=config.get("RULE_COST_TRIP_COUNT", 5),
+            disable=config.get("RULE_COST_DISABLE", False),
+        )
+    budget = None
+    budget_limits = (
+        config.get("RULE_EVALUATION_BUDGET_MS"),
+        config.get("RULE_EVALUATION_MAX_RULES"),
+        config.get("RULE_EVALUATION_MAX_REGEX_INPUT"),
+    )
+    if any(budget_limits):
+        budget = EvaluationBudget(*budget_limits)
+    backend = config.get("RULE_CHAIN_BACKEND")
+    shadow = config.get("RULE_CHAIN_SHADOW_BACKEND")
+    if shadow and random.random() < config.get("RULE_CHAIN_SHADOW_RATE", 0.0):
+        return shadow_monitor.run(
+            chain, metadata, backend or DEFAULT_BACKEND, shadow, budget
+        )
+    return chain.apply(metadata, backend, budget)
+
+
+def normalize_metadata(metadata: dict) -> dict:
+    """Convert digit-only string values to ints, in place, before classification.
+
+    Parameters
+    ----------
+    metadata : dict
+        The metadata for the entity.
+
+    Returns
+    -------
+    dict
+        The same metadata dict.
+    """
     for key, value in metadata.items():
         if type(value) is str:
             if value.isdigit():
                 metadata[key] = int(value)
-    rslt = rule_chain.apply(metadata)
-    # TODO: check that rslt has the expected parts
-    return rslt
+    return metadata
 
 
-def calculate_data_types(entity: Entity) -> list[str]:
+def calculate_data_types(entity: "Entity") -> list[str]:
     """Calculate the data types for the given entity.
 
     Parameters
@@ -96,7 +415,7 @@ def calculate_data_types(entity: Entity) -> list[str]:
     return data_types
 
 
-def build_entity_metadata(entity: Union[Entity, dict]) -> dict:
+def build_entity_metadata(entity: Union["Entity", dict]) -> dict:
     """Build the metadata for the given entity.
 
     Parameters
@@ -110,6 +429,8 @@ def build_entity_metadata(entity: Union[Entity, dict]) -> dict:
         The metadata for the entity.
     """
     if isinstance(entity, dict):
+        from hubmap_sdk import Entity
+
         entity = Entity(entity)
 
     metadata = {}
@@ -158,6 +479,152 @@ class RuleSyntaxException(Exception):
     pass
 
 
+class UnknownRuleChainException(Exception):
+    pass
+
+
+class UnknownBackendException(Exception):
+    pass
+
+
+class RulePatchException(Exception):
+    pass
+
+
+class EvaluationBudgetException(RuleLogicException):
+    pass
+
+
+class EvaluationBudget:
+    """
+    Limits on the work of one classification. Limits are checked before
+    each rule is evaluated, so a single rule can still overrun the time.
+    The one form of rule known to take long on its own, matching a regex
+    against a long string, is bounded by max_regex_input: a rule is not
+    evaluated if a record attribute it matches a regex against is longer.
+    """
+
+    __slots__ = ("max_ms", "max_rules", "max_regex_input", "deadline", "rules_left")
+
+    def __init__(
+        self, max_ms: float = None, max_rules: int = None, max_regex_input: int = None
+    ):
+        self.max_ms = max_ms
+        self.max_rules = max_rules
+        self.max_regex_input = max_regex_input
+        self.deadline = time.perf_counter() + max_ms / 1000 if max_ms else None
+        self.rules_left = max_rules
+
+    def renewed(self) -> "EvaluationBudget":
+        """A new budget with the same limits, starting now"""
+        return EvaluationBudget(self.max_ms, self.max_rules, self.max_regex_input)
+
+    def charge(self, idx: int, rec=None, regex_symbols=()):
+        """Account for evaluating the rule at idx, raising if over budget.
+
+        regex_symbols are the attributes of rec the rule matches regexes
+        against, see RuleChain.regex_symbols.
+        """
+        if self.max_regex_input:
+            for symbol in regex_symbols:
+                val = rec.get(symbol)
+                for elt in val if isinstance(val, (list, tuple)) else (val,):
+                    if isinstance(elt, str) and len(elt) > self.max_regex_input:
+                        raise EvaluationBudgetException(
+                            f"Rule {idx} matches {symbol} against a regex, and it"
+                            f" is longer than {self.max_regex_input} characters"
+                        )
+        if self.rules_left is not None:
+            self.rules_left -= 1
+            if self.rules_left < 0:
+                raise EvaluationBudgetException(
+                    f"Evaluation budget of {self.max_rules} rules exceeded"
+                    f" at rule {idx}"
+                )
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise EvaluationBudgetException(
+                f"Evaluation budget of {self.max_ms} ms exceeded at rule {idx}"
+            )
+
+
+def chain_content_hash(json_recs: list) -> str:
+    """Return a hash identifying the content of a list of chain records"""
+    canonical = json.dumps(json_recs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class RuleChainRegistry:
+    """
+    Holds several loaded rule chains, keyed by content hash and optionally by
+    a version name. Once more than max_size chains are held, the least
+    recently used ones are evicted; the active chain is never evicted.
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.chains = OrderedDict()  # content hash -> RuleChain
+        self.versions = {}  # version name -> content hash
+        self.active_hash = None
+        self.lock = threading.Lock()
+
+    def add(self, chain, version=None, activate=False):
+        with self.lock:
+            self.chains[chain.content_hash] = chain
+            self.chains.move_to_end(chain.content_hash)
+            if version:
+                self.versions[version] = chain.content_hash
+            if activate:
+                self.active_hash = chain.content_hash
+            self._evict()
+        return chain.content_hash
+
+    def get(self, selector):
+        """Return the chain for a version or content hash, or None"""
+        with self.lock:
+            content_hash = self.versions.get(selector, selector)
+            chain = self.chains.get(content_hash)
+            if chain is not None:
+                self.chains.move_to_end(content_hash)
+            return chain
+
+    def active(self):
+        """Return the active chain, or None"""
+        with self.lock:
+            return self.chains.get(self.active_hash)
+
+    def describe(self):
+        with self.lock:
+            return [
+                {
+                    "content_hash": content_hash,
+                    "versions": sorted(
+                        version
+                        for version, version_hash in self.versions.items()
+                        if version_hash == content_hash
+                    ),
+                    "rules": len(chain.links),
+                    "active": content_hash == self.active_hash,
+                }
+                for content_hash, chain in self.chains.items()
+            ]
+
+    def _evict(self):
+        for content_hash in list(self.chains):
+            if len(self.chains) <= self.max_size:
+                break
+            if content_hash != self.active_hash:
+                del self.chains[content_hash]
+        live_hashes = set(self.chains)
+        self.versions = {
+            version: content_hash
+            for version, content_hash in self.versions.items()
+            if content_hash in live_hashes
+        }
+
+
+rule_chain_registry = RuleChainRegistry()
+
+
 class RuleLoader:
     def __init__(self, stream, format="yaml"):
         self.stream = stream
@@ -165,8 +632,9 @@ class RuleLoader:
         self.format = format
 
     def load(self):
-        rule_chain = RuleChain()
         if self.format == "yaml":
+            import yaml
+
             json_recs = yaml.safe_load(self.stream)
         elif self.format == "json":
             if isinstance(self.stream, str):
@@ -175,18 +643,231 @@ class RuleLoader:
                 json_recs = json.load(self.stream)
         else:
             raise RuntimeError(f"Unknown format {self.format} for input stream")
-        check_json_matches_schema(
-            json_recs, SCHEMA_FILE, str(Path(__file__).parent), SCHEMA_BASE_URI
-        )
-        for rec in json_recs:
-            for rule in [rec[key] for key in ["match", "value"]]:
-                assert Rule.is_valid(rule), f"Syntax error in rule string {rule}"
+        return chain_from_records(json_recs)
+
+
+def validate_chain_records(json_recs: list):
+    """Check chain records against the chain schema"""
+    from hubmap_commons.schema_tools import check_json_matches_schema
+
+    check_json_matches_schema(
+        json_recs, SCHEMA_FILE, str(Path(__file__).parent), SCHEMA_BASE_URI
+    )
+
+
+def chain_from_records(json_recs: list, validate: bool = True) -> "RuleChain":
+    """Build a prepared RuleChain from its list of chain records.
+
+    Parameters
+    ----------
+    json_recs : list
+        The chain records.
+    validate : bool
+        Check the records against the chain schema. Only skip this for
+        records which have already been checked.
+    """
+    if validate:
+        validate_chain_records(json_recs)
+    rule_chain = RuleChain()
+    rule_chain.content_hash = chain_content_hash(json_recs)
+    for rec in json_recs:
+        rule_chain.add(build_rule(rec, rule_chain.context))
+    rule_chain.compact()
+    rule_chain.optimize()
+    rule_chain.prepare()
+    return rule_chain
+
+
+def resolve_item(thing, name):
+    """
+    Symbol resolver for rule Contexts. It behaves like rule_engine's default
+    resolver but does not compute a did-you-mean suggestion for missing
+    symbols; with default_value=None missing symbols are routine here, and
+    building suggestions dominated evaluation time.
+    """
+    try:
+        return thing[name]
+    except (KeyError, TypeError):
+        raise SymbolResolutionError(name, thing=thing) from None
+
+
+_MISSING = object()
+
+
+def build_rule(rec: dict, context: Context) -> "BaseRule":
+    """Compile one chain record into a MatchRule or NoteRule.
+
+    Raises
+    ------
+    RuleSyntaxException
+        If the record's type is unknown or a rule string does not parse.
+    """
+    for rule in [rec[key] for key in ["match", "value"]]:
+        if not Rule.is_valid(rule):
+            raise RuleSyntaxException(f"Syntax error in rule string {rule}")
+    try:
+        rule_cls = {"note": NoteRule, "match": MatchRule}[rec["type"].lower()]
+    except KeyError:
+        raise RuleSyntaxException(f"Unknown rule type {rec['type']}")
+    return rule_cls(
+        rec["match"],
+        rec["value"],
+        context=context,
+        rule_description=rec.get("rule_description"),
+    )
+
+
+def _patch_position(links: list, op: dict) -> int:
+    """The index in links of the rule a patch operation targets"""
+    inserting = op["op"] == "insert"
+    if "index" in op:
+        idx = op["index"]
+        limit = len(links) + 1 if inserting else len(links)
+        if not isinstance(idx, int) or not 0 <= idx < limit:
+            raise RulePatchException(f"Rule index {idx} is out of range")
+        return idx
+    if "rule_description" in op:
+        found = [
+            idx
+            for idx, elt in enumerate(links)
+            if elt.rule_description == op["rule_description"]
+        ]
+        if len(found) != 1:
+            raise RulePatchException(
+                f"{len(found)} rules have rule_description {op['rule_description']}"
+            )
+        return found[0] + 1 if inserting and op.get("after") else found[0]
+    raise RulePatchException("A patch operation needs an index or rule_description")
+
+
+class _NoteState:
+    """Lazily evaluated note outputs for one record passing through a chain"""
+
+    __slots__ = (
+        "chain",
+        "rec",
+        "present",
+        "budget",
+        "outputs",
+        "views",
+        "note_seconds",
+    )
+
+    def __init__(self, chain, rec, present, budget=None):
+        self.chain = chain
+        self.rec = rec
+        self.present = present  # chain.presence_mask(rec)
+        self.budget = budget
+        self.outputs = {}  # note index -> dict it adds, or None if no match
+        self.views = {}  # count of preceding notes -> _NoteView
+        # Time spent evaluating notes, when rule costs are being monitored
+        self.note_seconds = 0.0
+
+    def view(self, position):
+        """The record as seen by the link at the given chain position"""
+        note_count = self.chain.notes_before[position]
+        rec_view = self.views.get(note_count)
+        if rec_view is None:
+            rec_view = self.views[note_count] = _NoteView(self, position)
+        return rec_view
+
+    def note_output(self, idx):
+        if idx not in self.outputs:
+            elt = self.chain.links[idx]
+            required = self.chain.required_masks[idx]
+            rec_view = self.view(idx)
+            # A note may be evaluated in the middle of evaluating another
+            # rule, and Rule.evaluate resets the context's per-evaluation
+            # state (comprehension variables, regex groups), so save it
+            tls = self.chain.context._tls
+            scopes, regex_groups = list(tls.assignment_scopes), tls.regex_groups
+            monitor = self.chain.cost_monitor
+            started = time.perf_counter() if monitor is not None else None
+            nested_before = self.note_seconds
             try:
-                rule_cls = {"note": NoteRule, "match": MatchRule}[rec["type"].lower()]
-            except KeyError:
-                raise RuleSyntaxException(f"Unknown rule type {rec['type']}")
-            rule_chain.add(rule_cls(rec["match"], rec["value"]))
-        return rule_chain
+                if required & self.present != required:
+                    self.outputs[idx] = None
+                else:
+                    if self.budget is not None:
+                        self.budget.charge(idx, self.rec, self.chain.regex_symbols[idx])
+                    if elt.match_rule.matches(rec_view):
+                        self.outputs[idx] = elt.val_rule.evaluate(rec_view)
+                    else:
+                        self.outputs[idx] = None
+            finally:
+                tls.reset()
+                tls.assignment_scopes.extend(scopes)
+                tls.regex_groups = regex_groups
+                if started is not None:
+                    elapsed = time.perf_counter() - started
+                    monitor.record(idx, elapsed - (self.note_seconds - nested_before))
+                    self.note_seconds = nested_before + elapsed
+        return self.outputs[idx]
+
+
+class _NoteView(Mapping):
+    """
+    The record overlaid with the output of every matching note before a
+    given chain position, as ``rec | ctx`` would be in an eager walk. A note
+    is only evaluated when one of the symbols it sets is first looked up.
+    """
+
+    __slots__ = ("notes", "limit", "values")
+
+    def __init__(self, notes, limit):
+        self.notes = notes
+        self.limit = limit
+        self.values = {}
+
+    def _lookup(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+        val = self.notes.rec.get(name, _MISSING)
+        # The last matching note to set a symbol wins, so search backwards
+        for idx in reversed(self.notes.chain.note_producers.get(name, ())):
+            if idx < self.limit:
+                note_output = self.notes.note_output(idx)
+                if note_output is not None:
+                    val = note_output[name]
+                    break
+        self.values[name] = val
+        return val
+
+    def __getitem__(self, name):
+        val = self._lookup(name)
+        if val is _MISSING:
+            raise KeyError(name)
+        return val
+
+    def __contains__(self, name):
+        return self._lookup(name) is not _MISSING
+
+    def __iter__(self):
+        names = set(self.notes.rec)
+        for name, producers in self.notes.chain.note_producers.items():
+            if producers[0] < self.limit:
+                names.add(name)
+        return (name for name in names if name in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class _Condition:
+    """A sub-expression of a rule, evaluated as Rule.matches would"""
+
+    __slots__ = ("context", "expression")
+
+    def __init__(self, context, expression):
+        self.context = context
+        self.expression = expression
+
+    def matches(self, thing) -> bool:
+        self.context._tls.reset()
+        with decimal.localcontext(self.context.decimal_context):
+            return bool(self.expression.evaluate(thing))
 
 
 class _RuleChainIter:
@@ -209,9 +890,291 @@ class _RuleChainIter:
 class RuleChain:
     def __init__(self):
         self.links = []
+        self.content_hash = None
+        # One Context is shared by every rule in the chain
+        self.context = Context(default_value=None, resolver=resolve_item)
+        self.prepared = False
+        self.symbol_names = frozenset()
+        self.regex_symbols = []
+        self.cost_monitor = None  # a lib.rule_costs.RuleCostMonitor
+        self.disabled_rules = set()
 
     def add(self, link):
         self.links.append(link)
+        self.prepared = False
+
+    def optimize(self):
+        """
+        Rewrite membership tests against literal arrays, like
+        ``assay_type in ['a', 'b']``, as hashed set lookups.
+        """
+        memo = {}
+        for elt in self.links:
+            for rule in (elt.match_rule, elt.val_rule):
+                rule.statement.expression = rewrite_membership(
+                    rule.statement.expression, memo
+                )
+        self.prepared = False
+
+    def prepare(self):
+        """
+        Build the indexes apply() uses. NoteRules are evaluated lazily, so
+        this records which notes can set each symbol (in chain order) and
+        how many notes precede each link. Lazy evaluation needs to know what
+        every note sets; if any note's value is not a mapping literal with
+        literal keys, the chain falls back to evaluating notes eagerly.
+        """
+        note_producers = defaultdict(list)
+        notes_before = []
+        note_count = 0
+        lazy_notes = True
+        for idx, elt in enumerate(self.links):
+            notes_before.append(note_count)
+            if isinstance(elt, NoteRule):
+                note_count += 1
+                keys = mapping_literal_keys(elt.val_rule.statement.expression)
+                if keys is None:
+                    lazy_notes = False
+                    continue
+                for key in keys:
+                    note_producers[key].append(idx)
+        self.note_producers = dict(note_producers)
+        self.notes_before = notes_before
+        self.lazy_notes = lazy_notes
+        # Every record attribute the rules read, e.g. for entity tags
+        self.symbol_names = frozenset(
+            symbol
+            for elt in self.links
+            for rule in (elt.match_rule, elt.val_rule)
+            for symbol in referenced_symbols(rule.statement.expression)
+        )
+        # The record attributes each rule matches regexes against, for
+        # EvaluationBudget.max_regex_input
+        self.regex_symbols = [
+            tuple(
+                regex_subjects(elt.match_rule.statement.expression)
+                | regex_subjects(elt.val_rule.statement.expression)
+            )
+            for elt in self.links
+        ]
+
+        # Presence prefilter: a bit mask per link of the record attributes
+        # which must be non-null for it to match. Symbols a note can set are
+        # left out, as their values do not come from the record alone.
+        self.symbol_bits = {}
+        self.required_masks = []
+        for idx, elt in enumerate(self.links):
+            mask = 0
+            if idx in self.disabled_rules:
+                mask = DISABLED_MASK
+            elif lazy_notes:
+                for symbol in required_symbols(elt.match_rule.statement.expression):
+                    if symbol not in self.note_producers:
+                        if symbol not in self.symbol_bits:
+                            self.symbol_bits[symbol] = 1 << len(self.symbol_bits)
+                        mask |= self.symbol_bits[symbol]
+            self.required_masks.append(mask)
+        self.guards = self._find_guards()
+        self.prepared = True
+
+    def _find_guards(self) -> list:
+        """
+        Find runs of consecutive MatchRules whose conditions start with the
+        same conjunction, e.g. ``not_dcwg and not_derived and ...``. For each
+        rule in a run, return (run number, the shared guard, the rest of the
+        rule's condition), or None for rules in no run. Shared subtrees are
+        single objects once the chain is compacted, so sharing is identity.
+        """
+        links = self.links
+        guards = [None] * len(links)
+        run_count = 0
+        start = 0
+        while start < len(links):
+            if not isinstance(links[start], MatchRule):
+                start += 1
+                continue
+            first_prefixes = and_prefixes(links[start].match_rule.statement.expression)
+            common = {id(node) for node, _ in first_prefixes}
+            end = start + 1
+            # Runs stop at notes, which may change what the guard sees
+            while end < len(links) and isinstance(links[end], MatchRule):
+                prefix_ids = {
+                    id(node)
+                    for node, _ in and_prefixes(
+                        links[end].match_rule.statement.expression
+                    )
+                }
+                if not common & prefix_ids:
+                    break
+                common &= prefix_ids
+                end += 1
+            if end - start > 1:
+                # Prefixes are listed longest first
+                guard = next(node for node, _ in first_prefixes if id(node) in common)
+                guard_condition = _Condition(self.context, guard)
+                for idx in range(start, end):
+                    rest = next(
+                        rest
+                        for node, rest in and_prefixes(
+                            links[idx].match_rule.statement.expression
+                        )
+                        if node is guard
+                    )
+                    guards[idx] = (
+                        run_count,
+                        guard_condition,
+                        _Condition(self.context, conjoin(self.context, rest)),
+                    )
+                run_count += 1
+            start = end
+        return guards
+
+    @property
+    def result_hash(self) -> str:
+        """
+        Identifies the results the chain gives, for keying stored and cached
+        results and entity tags: the content hash, plus the rules disabled in
+        this process if there are any.
+        """
+        if not self.disabled_rules:
+            return self.content_hash
+        disabled = ",".join(str(idx) for idx in sorted(self.disabled_rules))
+        return (
+            f"{self.content_hash}-{hashlib.sha256(disabled.encode()).hexdigest()[:16]}"
+        )
+
+    def disable_rule(self, idx: int):
+        """Treat the rule at idx as never matching from now on.
+
+        This only affects this process. Results computed before, or by other
+        workers, are keyed by a different result_hash and not served in its
+        place.
+        """
+        self.disabled_rules.add(idx)
+        if self.prepared:
+            self.required_masks[idx] = DISABLED_MASK
+
+    def presence_mask(self, rec) -> int:
+        """Return the bits of the prefilter attributes which rec has non-null"""
+        present = 0
+        symbol_bits = self.symbol_bits
+        for name, val in rec.items():
+            if val is not None and name in symbol_bits:
+                present |= symbol_bits[name]
+        return present
+
+    def compact(self, only: list = None):
+        """
+        Shrink the chain's memory footprint by interning strings and sharing
+        structurally identical sub-expressions between rules.
+
+        Parameters
+        ----------
+        only : list, optional
+            Compact only these links. They share sub-expressions with the
+            chain's other links, which are left unchanged.
+        """
+        canon = {}
+        key_memo = {}
+        if only is not None:
+            only_ids = {id(elt) for elt in only}
+            for elt in self.links:
+                if id(elt) not in only_ids:
+                    for rule in (elt.match_rule, elt.val_rule):
+                        for node in iter_nodes(rule.statement.expression):
+                            canon.setdefault(node_key(node, key_memo), node)
+        for elt in self.links if only is None else only:
+            for rule in (elt.match_rule, elt.val_rule):
+                rule.text = sys.intern(rule.text)
+                rule.statement.expression = compact_expression(
+                    rule.statement.expression, canon, key_memo
+                )
+
+    def patched(self, operations: list) -> "RuleChain":
+        """Return a copy of the chain with rules inserted, replaced or removed.
+
+        Only the rules in the patch are validated and compiled; the others
+        are shared with this chain, which is left unchanged.
+
+        Parameters
+        ----------
+        operations : list
+            Applied in order, so each operation sees the chain as left by
+            the ones before it. Each is a dict with an "op" of "insert",
+            "replace" or "remove", and either the "index" of a rule or the
+            "rule_description" of exactly one rule. "insert" puts the new
+            rule at the index or before the described rule (after it if
+            "after" is true); "insert" and "replace" take the new chain
+            record as "rule".
+
+        Returns
+        -------
+        RuleChain
+            The patched chain, with its own content hash.
+
+        Raises
+        ------
+        RulePatchException
+            If an operation is malformed or does not identify one rule.
+        RuleSyntaxException
+            If a new rule is not a valid chain record.
+        """
+        new_recs = [op.get("rule") for op in operations if op.get("op") != "remove"]
+        try:
+            validate_chain_records(new_recs)
+        except Exception as excp:
+            raise RuleSyntaxException(f"Invalid rule in patch: {excp}") from excp
+        links = list(self.links)
+        for op in operations:
+            kind = op.get("op")
+            if kind not in ("insert", "replace", "remove"):
+                raise RulePatchException(f"Unknown patch operation {kind}")
+            idx = _patch_position(links, op)
+            if kind == "insert":
+                links.insert(idx, build_rule(op["rule"], self.context))
+            elif kind == "replace":
+                links[idx] = build_rule(op["rule"], self.context)
+            else:
+                del links[idx]
+        new_chain = RuleChain()
+        new_chain.context = self.context
+        new_chain.links = links
+        new_chain.content_hash = chain_content_hash([elt.to_record() for elt in links])
+        new_chain.optimize()
+        # The shared rules are already optimized, so the new ones only match
+        # their sub-expressions, such as guards, once they are optimized too
+        old_ids = {id(elt) for elt in self.links}
+        new_chain.compact(only=[elt for elt in links if id(elt) not in old_ids])
+        new_chain.prepare()
+        return new_chain
+
+    def referenced_symbols(self) -> frozenset:
+        """Return the names of every record attribute the chain's rules read"""
+        if not self.prepared:
+            self.prepare()
+        return self.symbol_names
+
+    def memory_footprint(self) -> dict:
+        """Report the approximate memory held by the chain's rules.
+
+        Returns
+        -------
+        dict
+            The number of rules, the number of distinct AST nodes, and the
+            estimated total size in bytes of the rules and their ASTs.
+        """
+        return {
+            "rules": len(self.links),
+            "ast_nodes": len(
+                {
+                    id(node)
+                    for elt in self.links
+                    for rule in (elt.match_rule, elt.val_rule)
+                    for node in iter_nodes(rule.statement.expression)
+                }
+            ),
+            "bytes": deep_sizeof(self.links),
+        }
 
     def dump(self, ofile):
         print(f"START DUMP of {len(list(iter(self)))} rules")
@@ -229,20 +1192,87 @@ class RuleChain:
         """
         if isinstance(val, dict):  # includes OrderedDict
             return dict({cls.cleanup(key): cls.cleanup(val[key]) for key in val})
-        elif isinstance(val, list):
+        elif isinstance(val, (list, tuple)):
+            # rule_engine gives arrays as tuples
             return list(cls.cleanup(elt) for elt in val)
         else:
             return val
 
-    def apply(self, rec):
+    def evaluate(self, rec, backend: str = None, budget=None) -> tuple:
+        """Find the first MatchRule matching rec.
+
+        Parameters
+        ----------
+        rec : dict
+            The normalized metadata to classify.
+        backend : str, optional
+            The name of the evaluation backend to use, from
+            ``EVALUATION_BACKENDS``. Defaults to ``DEFAULT_BACKEND``.
+        budget : EvaluationBudget, optional
+            Limits on the work the evaluation may do.
+
+        Returns
+        -------
+        tuple
+            (index of the matching rule in links, its value)
+
+        Raises
+        ------
+        NoMatchException
+            If no rule matches.
+        RuleLogicException
+            If a rule fails to evaluate.
+        EvaluationBudgetException
+            If the evaluation goes over budget.
+        """
+        if not self.prepared:
+            self.prepare()
+        idx, val = get_evaluation_backend(backend).evaluate(self, rec, budget)
+        return idx, self.cleanup(val)
+
+    def apply(self, rec, backend: str = None, budget=None):
+        """Return the value of the first MatchRule matching rec"""
+        return self.evaluate(rec, backend, budget)[1]
+
+
+class EvaluationBackend:
+    """
+    A strategy for evaluating a prepared RuleChain against one record. Every
+    backend must give the same result as LinearBackend, the reference.
+    """
+
+    name = None
+
+    def evaluate(self, chain: RuleChain, rec, budget=None) -> tuple:
+        """Return (rule index, raw value) as RuleChain.evaluate describes.
+
+        Backends skip the chain's disabled rules, charge the budget for each
+        rule they evaluate, and report rule latencies to the chain's cost
+        monitor if it has one.
+        """
+        raise NotImplementedError
+
+
+class LinearBackend(EvaluationBackend):
+    """Walk every link in order, evaluating each note as it is reached"""
+
+    name = "linear"
+
+    def evaluate(self, chain, rec, budget=None):
         ctx = {}  # so rules can leave notes for later rules
-        for elt in iter(self):
+        monitor = chain.cost_monitor
+        for idx, elt in enumerate(chain.links):
+            if idx in chain.disabled_rules:
+                continue
+            if budget is not None:
+                budget.charge(idx, rec, chain.regex_symbols[idx])
             rec_dict = rec | ctx
+            started = time.perf_counter() if monitor is not None else None
             try:
                 if elt.match_rule.matches(rec_dict):
                     val = elt.val_rule.evaluate(rec_dict)
                     if isinstance(elt, MatchRule):
-                        return self.cleanup(val)
+                        return idx, val
                     elif isinstance(elt, NoteRule):
                         assert isinstance(
                             val, dict
@@ -253,21 +1283,117 @@ class RuleChain:
             except EngineError as excp:
                 print(f"ENGINE_ERROR {type(excp)} {excp}")
                 raise RuleLogicException(excp) from excp
+            finally:
+                if started is not None:
+                    monitor.record(idx, time.perf_counter() - started)
         raise NoMatchException(f"No rule matched record {rec}")
 
 
+class IndexedBackend(EvaluationBackend):
+    """
+    Use the indexes built by RuleChain.prepare(). Notes are only evaluated
+    when a rule reads a symbol they set, and each at most once per record,
+    rules needing an attribute rec does not have are skipped unevaluated,
+    and a guard shared by a run of rules is evaluated once for the run.
+    The result is the same as the linear walk gives, except that an error in
+    a note nobody reads goes unreported.
+    """
+
+    name = "indexed"
+
+    def evaluate(self, chain, rec, budget=None):
+        if not chain.lazy_notes:
+            return EVALUATION_BACKENDS["linear"].evaluate(chain, rec, budget)
+        present = chain.presence_mask(rec)
+        notes = _NoteState(chain, rec, present, budget)
+        monitor = chain.cost_monitor
+        required_masks = chain.required_masks
+        guards = chain.guards
+        guard_values = {}  # run number -> whether its guard holds
+        for idx, elt in enumerate(chain.links):
+            if isinstance(elt, NoteRule):
+                continue  # evaluated on demand through the views
+            required = required_masks[idx]
+            if required & present != required:
+                continue  # the rule needs an attribute rec lacks
+            if budget is not None:
+                budget.charge(idx, rec, chain.regex_symbols[idx])
+            rec_view = notes.view(idx)
+            if monitor is not None:
+                started, notes_before = time.perf_counter(), notes.note_seconds
+            try:
+                if guards[idx] is None:
+                    matched = elt.match_rule.matches(rec_view)
+                else:
+                    run, guard, rest = guards[idx]
+                    if run not in guard_values:
+                        guard_values[run] = guard.matches(rec_view)
+                    matched = guard_values[run] and rest.matches(rec_view)
+                if matched:
+                    return idx, elt.val_rule.evaluate(rec_view)
+            except EngineError as excp:
+                logger.error(f"Rule {idx} raised {type(excp).__name__}: {excp}")
+                raise RuleLogicException(excp) from excp
+            finally:
+                if monitor is not None:
+                    elapsed = time.perf_counter() - started
+                    monitor.record(idx, elapsed - (notes.note_seconds - notes_before))
+        raise NoMatchException(f"No rule matched record {rec}")
+
+
+# A required-attribute mask no record can satisfy
+DISABLED_MASK = -1
+
+EVALUATION_BACKENDS = {
+    backend.name: backend for backend in [LinearBackend(), IndexedBackend()]
+}
+DEFAULT_BACKEND = "indexed"
+
+
+def get_evaluation_backend(name: str = None) -> EvaluationBackend:
+    try:
+        return EVALUATION_BACKENDS[name or DEFAULT_BACKEND]
+    except KeyError:
+        raise UnknownBackendException(
+            f"Unknown evaluation backend {name}; known backends are"
+            f" {sorted(EVALUATION_BACKENDS)}"
+        ) from None
+
+
 class BaseRule:
-    def __init__(self, rule_str, val_str):
-        rule_ctx = Context(default_value=None)
-        self.match_rule = Rule(rule_str, context=rule_ctx)
-        self.val_rule = Rule(val_str, context=rule_ctx)
+    __slots__ = ("match_rule", "val_rule", "rule_description")
+    rule_type = None
+
+    def __init__(self, rule_str, val_str, context=None, rule_description=None):
+        if context is None:
+            context = Context(default_value=None, resolver=resolve_item)
+        self.match_rule = Rule(rule_str, context=context)
+        self.val_rule = Rule(val_str, context=context)
+        self.rule_description = rule_description
+
+    def to_record(self):
+        """Return the chain record this rule was built from"""
+        rec = {
+            "type": self.rule_type,
+            "match": self.match_rule.text,
+            "value": self.val_rule.text,
+        }
+        if self.rule_description is not None:
+            rec["rule_description"] = self.rule_description
+        return rec
 
 
 class MatchRule(BaseRule):
+    __slots__ = ()
+    rule_type = "match"
+
     def __str__(self):
         return f"<MatchRule({self.match_rule}, {self.val_rule})>"
 
 
 class NoteRule(BaseRule):
+    __slots__ = ()
+    rule_type = "note"
+
     def __str__(self):
         return f"<NoteRule({self.match_rule}, {self.val_rule}>"
@@ -0,0 +1,89 @@
+"""
+Per-rule latency tracking and a circuit breaker for slow rules.
+
+A RuleCostMonitor is attached to a RuleChain and told how long each rule
+took to evaluate. A rule whose evaluation exceeds the cost threshold more
+than a set number of times is flagged and logged, and can optionally be
+disabled so the chain treats it as never matching.
+"""
+
+import logging
+import threading
+import time
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class RuleCostMonitor:
+    def __init__(
+        self, chain, threshold_ms: float, trip_count: int = 5, disable: bool = False
+    ):
+        self.chain = chain
+        self.threshold = threshold_ms / 1000
+        self.threshold_ms = threshold_ms
+        self.trip_count = trip_count
+        self.disable = disable
+        self.lock = threading.Lock()
+        # rule index -> [evaluations, total seconds, max seconds, times over]
+        self.stats = {}
+        self.flagged = {}  # rule index -> time flagged
+
+    def record(self, idx: int, seconds: float):
+        """Note one evaluation of the rule at idx.
+
+        The time of a rule excludes the notes it caused to be evaluated.
+        """
+        with self.lock:
+            stats = self.stats.get(idx)
+            if stats is None:
+                stats = self.stats[idx] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+            if seconds <= self.threshold:
+                return
+            stats[3] += 1
+            if stats[3] < self.trip_count or idx in self.flagged:
+                return
+            self.flagged[idx] = time.time()
+            over = stats[3]
+        self._trip(idx, over)
+
+    def _trip(self, idx: int, over: int):
+        if self.disable:
+            self.chain.disable_rule(idx)
+        logger.warning(
+            f"Rule {idx} of chain {self.chain.content_hash} took over"
+            f" {self.threshold_ms} ms {over} times"
+            f"{'; disabled it in this process' if self.disable else ''}:"
+            f" {self.chain.links[idx].to_record()}"
+        )
+
+    def _describe_rule(self, idx: int, stats: dict) -> dict:
+        evaluations, total, longest, over = stats[idx]
+        return {
+            "rule_index": idx,
+            "rule": self.chain.links[idx].to_record(),
+            "evaluations": evaluations,
+            "over_threshold": over,
+            "mean_ms": round(1000 * total / evaluations, 3),
+            "max_ms": round(1000 * longest, 3),
+            "flagged": self.flagged.get(idx),
+            "disabled": idx in self.chain.disabled_rules,
+        }
+
+    def describe(self, slowest: int = 5) -> dict:
+        """The flagged rules, and the rules slowest on average"""
+        with self.lock:
+            stats = {idx: list(vals) for idx, vals in self.stats.items()}
+            flagged = sorted(self.flagged)
+        by_mean = sorted(list(stats), key=lambda idx: stats[idx][1] / stats[idx][0])
+        return {
+            "threshold_ms": self.threshold_ms,
+            "trip_count": self.trip_count,
+            "flagged": [self._describe_rule(idx, stats) for idx in flagged],
+            "slowest": [
+                self._describe_rule(idx, stats) for idx in by_mean[::-1][:slowest]
+            ],
+        }
@@ -0,0 +1,136 @@
+"""
+Shadow evaluation: run a classification through a second evaluation backend
+as well as the serving one, and compare the two.
+
+The serving backend's outcome is always what the caller gets. The shadow
+backend's outcome is only compared against it, so an alternate backend can
+be proven equivalent, and its speed measured, on real traffic before it is
+switched on.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def _timed_outcome(chain, rec, backend: str, budget=None) -> tuple:
+    """Return ((kind, rule index, value or exception), seconds)"""
+    start = time.perf_counter()
+    try:
+        idx, val = chain.evaluate(rec, backend, budget)
+        outcome = ("match", idx, val)
+    except Exception as excp:
+        outcome = ("exception", None, excp)
+    return outcome, time.perf_counter() - start
+
+
+def _same_outcome(a: tuple, b: tuple) -> bool:
+    if a[0] == "match" or b[0] == "match":
+        return a == b
+    # Exceptions never compare equal, so compare their type and message
+    return (type(a[2]), str(a[2])) == (type(b[2]), str(b[2]))
+
+
+def _describe_outcome(outcome: tuple) -> dict:
+    kind, idx, val = outcome
+    if kind == "match":
+        return {"rule_index": idx, "value": val}
+    return {"exception": f"{type(val).__name__}: {val}"}
+
+
+class ShadowMonitor:
+    """Runs shadow comparisons and keeps their statistics"""
+
+    def __init__(self, window: int = 1000, keep_mismatches: int = 20):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pairs = {}
+        self.mismatches = deque(maxlen=keep_mismatches)
+
+    def run(self, chain, rec, primary: str, shadow: str, budget=None):
+        """Evaluate rec with both backends and return the primary's value.
+
+        Each backend gets its own budget with the limits of the given one.
+        Raises whatever the primary backend raised.
+        """
+        primary_outcome, primary_secs = _timed_outcome(chain, rec, primary, budget)
+        shadow_outcome, shadow_secs = _timed_outcome(
+            chain, rec, shadow, budget.renewed() if budget is not None else None
+        )
+        same = _same_outcome(primary_outcome, shadow_outcome)
+        self._record(primary, shadow, primary_secs, shadow_secs, same)
+        if not same:
+            mismatch = {
+                "content_hash": chain.content_hash,
+                "record": rec,
+                primary: _describe_outcome(primary_outcome),
+                shadow: _describe_outcome(shadow_outcome),
+            }
+            with self.lock:
+                self.mismatches.append(mismatch)
+            logger.warning(f"Shadow backend mismatch: {mismatch}")
+        kind, _, val = primary_outcome
+        if kind == "exception":
+            raise val
+        return val
+
+    def _record(self, primary, shadow, primary_secs, shadow_secs, same):
+        key = f"{primary}/{shadow}"
+        with self.lock:
+            pair = self.pairs.get(key)
+            if pair is None:
+                pair = self.pairs[key] = {
+                    "compared": 0,
+                    "mismatches": 0,
+                    "latencies": {
+                        primary: deque(maxlen=self.window),
+                        shadow: deque(maxlen=self.window),
+                    },
+                }
+            pair["compared"] += 1
+            pair["mismatches"] += not same
+            pair["latencies"][primary].append(primary_secs)
+            pair["latencies"][shadow].append(shadow_secs)
+
+    def describe(self) -> dict:
+        """Comparison counts and latency percentiles, in ms, per backend pair"""
+        with self.lock:
+            return {
+                "pairs": {
+                    key: {
+                        "compared": pair["compared"],
+                        "mismatches": pair["mismatches"],
+                        "latency_ms": {
+                            backend: latency_summary(secs)
+                            for backend, secs in pair["latencies"].items()
+                        },
+                    }
+                    for key, pair in self.pairs.items()
+                },
+                "recent_mismatches": list(self.mismatches),
+            }
+
+
+def latency_summary(secs) -> dict:
+    """Summarize a sample of durations in seconds as millisecond percentiles"""
+    ordered = sorted(secs)
+    if not ordered:
+        return {"count": 0}
+
+    def pct(p):
+        return round(1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(1000 * sum(ordered) / len(ordered), 3),
+        "p50": pct(0.5),
+        "p90": pct(0.9),
+        "p99": pct(0.99),
+        "max": round(1000 * ordered[-1], 3),
+    }
+
+
+shadow_monitor = ShadowMonitor()
@@ -0,0 +1,90 @@
+"""
+Coalescing of concurrent identical calls within one process.
+
+While a call for some key is in flight, later callers with the same key wait
+for it and share its outcome instead of repeating the work. Nothing is kept
+once the call completes, so results are never stale.
+"""
+
+import copy
+import threading
+from typing import Any, Callable, Hashable
+
+from werkzeug.datastructures import Headers
+from werkzeug.wrappers import Response
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def copy_error(excp: BaseException) -> BaseException:
+    """
+    A copy of an exception for one waiting caller, so that callers handling
+    it never share state through it. In particular each gets its own copy of
+    the Response a ResponseException carries, since response hooks modify it.
+    """
+    try:
+        copied = copy.copy(excp)
+    except Exception:
+        return excp
+    response = getattr(copied, "response", None)
+    if isinstance(response, Response) and not response.is_streamed:
+        copied.response = type(response)(
+            response.get_data(),
+            status=response.status,
+            headers=Headers(response.headers),
+        )
+    return copied
+
+
+class SingleFlight:
+    """A set of in-flight calls, keyed by what they compute"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return fn(), sharing one execution among concurrent callers.
+
+        Parameters
+        ----------
+        key : Hashable
+            Identifies the call; concurrent callers with equal keys must be
+            asking for the same thing.
+        fn : Callable
+            Computes the result. Only the first caller for a key runs it.
+
+        Returns
+        -------
+        Any
+            The result of fn. If fn raises, the exception is raised to the
+            caller which ran it, and a copy of it to each caller which waited.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise copy_error(call.error).with_traceback(call.error.__traceback__)
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as excp:
+            # Waiters copy this copy, since the caller's own may be modified
+            call.error = copy_error(excp)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,179 @@
+"""
+Per-stage latency instrumentation for request handlers.
+
+Handlers wrap each stage of their work in ``with stage("name"):``. The spans
+of a request are collected on ``flask.g``, and when the response is ready
+they are added to latency histograms per route and stage. They can also be
+written to an NDJSON file, exported as OpenTelemetry spans, and echoed in a
+``Server-Timing`` response header.
+
+Configuration
+-------------
+STAGE_TIMING_LOG_PATH
+    Append one NDJSON line per request with its spans to this file.
+STAGE_TIMING_OTEL
+    Export spans through the OpenTelemetry API, if it is installed.
+SERVER_TIMING_HEADER
+    Add a Server-Timing header to responses.
+
+Work done while a streamed response is generated happens after the response
+hooks have run, so it is not included.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Blueprint, current_app, g, has_request_context, request
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in ms; a final bucket holds the rest
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def describe(self) -> dict:
+        bounds = [f"le_{bound}" for bound in BUCKETS_MS] + ["le_inf"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+class StageTimings:
+    """Latency histograms keyed by route, then by stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, route: str, stage_name: str, ms: float):
+        with self.lock:
+            stages = self.routes.setdefault(route, {})
+            if stage_name not in stages:
+                stages[stage_name] = LatencyHistogram()
+            stages[stage_name].observe(ms)
+
+    def describe(self) -> dict:
+        with self.lock:
+            return {
+                route: {name: hist.describe() for name, hist in stages.items()}
+                for route, stages in self.routes.items()
+            }
+
+
+stage_timings = StageTimings()
+_log_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as a stage of the current request.
+
+    Outside a request context this does nothing, so library code can be
+    instrumented without depending on being called from a route.
+    """
+    if not has_request_context() or "stage_spans" not in g:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.stage_spans.append((name, start, time.perf_counter()))
+
+
+def install_stage_timing(blueprint: Blueprint):
+    """Collect stage spans for every request routed to the blueprint"""
+    blueprint.before_request(_start_request)
+    blueprint.after_request(_finish_request)
+
+
+def _start_request():
+    g.stage_spans = []
+    g.stage_start_wall = time.time()
+    g.stage_start = time.perf_counter()
+
+
+def _finish_request(response):
+    if "stage_spans" not in g:
+        return response
+    end = time.perf_counter()
+    route = f"{request.method} {request.url_rule.rule if request.url_rule else '-'}"
+    spans = g.stage_spans + [("total", g.stage_start, end)]
+    for name, start, stop in spans:
+        stage_timings.observe(route, name, 1000 * (stop - start))
+    config = current_app.config
+    if config.get("SERVER_TIMING_HEADER"):
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={1000 * (stop - start):.2f}" for name, start, stop in spans
+        )
+    try:
+        if config.get("STAGE_TIMING_LOG_PATH"):
+            _write_log(config["STAGE_TIMING_LOG_PATH"], route, response, spans)
+        if config.get("STAGE_TIMING_OTEL") and trace is not None:
+            _export_otel(route, spans)
+    except Exception as excp:
+        # Instrumentation must never fail the request
+        logger.warning(f"Could not export stage timings: {excp}")
+    return response
+
+
+def _write_log(log_path: str, route: str, response, spans: list):
+    line = json.dumps(
+        {
+            "time": g.stage_start_wall,
+            "route": route,
+            "status": response.status_code,
+            "stages": [
+                {
+                    "name": name,
+                    "offset_ms": round(1000 * (start - g.stage_start), 3),
+                    "duration_ms": round(1000 * (stop - start), 3),
+                }
+                for name, start, stop in spans
+            ],
+        }
+    )
+    with _log_lock, open(log_path, "a") as f:
+        f.write(line + "\n")
+
+
+def _export_otel(route: str, spans: list):
+    """Replay the spans through the OpenTelemetry API, nested under the request"""
+    tracer = trace.get_tracer(__name__)
+
+    def ns(perf_time):
+        return int(1e9 * (g.stage_start_wall + perf_time - g.stage_start))
+
+    *stages, (_, start, stop) = spans
+    root = tracer.start_span(route, start_time=ns(start))
+    context = trace.set_span_in_context(root)
+    for name, stage_start, stage_stop in stages:
+        tracer.start_span(name, context=context, start_time=ns(stage_start)).end(
+            end_time=ns(stage_stop)
+        )
+    root.end(end_time=ns(stop))
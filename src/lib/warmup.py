@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+
+from flask import Flask, current_app
+
+from lib.chain_diff import load_corpus
+from lib.entity_classification import classify_uuid
+from lib.rule_chain import (
+    NoMatchException,
+    RuleLogicException,
+    calculate_assay_info,
+    initialize_rule_chain,
+)
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class WarmupState:
+    """Progress of this process's warm-up, as reported by the readiness route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.status = "disabled"  # or "running", "ready", "failed"
+        self.ready = True  # until a warm-up is started
+        self.runs = 0
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+        self.records = 0
+        self.uuids = 0
+        self.errors = 0
+        self.error = None
+
+    def describe(self) -> dict:
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "status": self.status,
+                "runs": self.runs,
+                "attempts": self.attempts,
+                "started": self.started,
+                "finished": self.finished,
+                "records": self.records,
+                "uuids": self.uuids,
+                "errors": self.errors,
+                "error": self.error,
+            }
+
+
+warmup_state = WarmupState()
+
+# The longest wait between warm-up attempts, in seconds
+MAX_RETRY_DELAY = 60
+
+
+def start_warmup(app: Flask, reload_chain: bool = True) -> bool:
+    """Warm up this process in a background thread.
+
+    Loads the rule chain, then classifies the metadata records in the
+    ``WARMUP_CORPUS_PATH`` NDJSON file and the entities listed one uuid per
+    line in ``WARMUP_UUIDS_PATH``. Classifying uuids fills the classification
+    cache and store, if they are configured. The process reports not ready until the
+    first warm-up has finished; later ones, e.g. after a reload, run while it
+    keeps serving.
+
+    A failed warm-up is retried up to ``WARMUP_RETRIES`` times (default 5),
+    waiting ``WARMUP_RETRY_DELAY`` seconds (default 1) before the first retry
+    and twice as long before each later one. If every attempt fails the
+    status is "failed", which the readiness route reports with a 500 so the
+    process can be replaced.
+
+    Call this from the app factory when ``WARMUP_ENABLED`` is set. Under
+    gunicorn with ``preload_app``, call it from a ``post_fork`` hook instead,
+    since threads started in the master do not survive the fork.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The application whose config drives the warm-up.
+    reload_chain : bool
+        If False, warm up the chain already loaded instead of loading it.
+
+    Returns
+    -------
+    bool
+        True if a warm-up was started, False if warm-up is disabled or one is
+        already running.
+    """
+    if not app.config.get("WARMUP_ENABLED", False):
+        return False
+    with warmup_state.lock:
+        if warmup_state.status == "running":
+            return False
+        warmup_state.status = "running"
+        warmup_state.runs += 1
+        warmup_state.started = time.time()
+        warmup_state.finished = None
+        warmup_state.records = warmup_state.uuids = warmup_state.errors = 0
+        warmup_state.error = None
+        if warmup_state.runs == 1:
+            warmup_state.ready = False
+    threading.Thread(
+        target=_run_warmup, args=(app, reload_chain), name="warmup", daemon=True
+    ).start()
+    return True
+
+
+def _run_warmup(app: Flask, reload_chain: bool):
+    """Warm up, retrying with exponential backoff if the warm-up itself fails,
+    e.g. because the rule chain could not be fetched"""
+    retries = app.config.get("WARMUP_RETRIES", 5)
+    delay = app.config.get("WARMUP_RETRY_DELAY", 1.0)
+    for attempt in range(retries + 1):
+        with warmup_state.lock:
+            warmup_state.attempts = attempt + 1
+            warmup_state.records = warmup_state.uuids = warmup_state.errors = 0
+        try:
+            _warm_up(app, reload_chain)
+            break
+        except Exception as excp:
+            logger.error(excp, exc_info=True)
+            with warmup_state.lock:
+                warmup_state.error = str(excp)
+                if attempt == retries:
+                    # Final: the readiness route reports it as an error
+                    warmup_state.status = "failed"
+                    warmup_state.finished = time.time()
+                    return
+            time.sleep(min(delay * 2**attempt, MAX_RETRY_DELAY))
+    with warmup_state.lock:
+        warmup_state.status = "ready"
+        warmup_state.ready = True
+        warmup_state.error = None
+        warmup_state.finished = time.time()
+        summary = dict(
+            records=warmup_state.records,
+            uuids=warmup_state.uuids,
+            errors=warmup_state.errors,
+            attempts=warmup_state.attempts,
+            seconds=round(warmup_state.finished - warmup_state.started, 3),
+        )
+    logger.info(f"Warm-up finished: {summary}")
+
+
+def _warm_up(app: Flask, reload_chain: bool):
+    with app.app_context():
+        if reload_chain:
+            initialize_rule_chain()
+        corpus_path = current_app.config.get("WARMUP_CORPUS_PATH")
+        if corpus_path:
+            for entry in load_corpus(corpus_path):
+                # Accept bare metadata or reclassification corpus entries
+                _warm(calculate_assay_info, entry.get("metadata", entry))
+                with warmup_state.lock:
+                    warmup_state.records += 1
+        uuids_path = current_app.config.get("WARMUP_UUIDS_PATH")
+        if uuids_path:
+            token = current_app.config.get("WARMUP_AUTH_TOKEN")
+            for uuid in _read_uuids(uuids_path):
+                _warm(classify_uuid, uuid, token, None)
+                with warmup_state.lock:
+                    warmup_state.uuids += 1
+
+
+def _warm(fn, *args):
+    """Run one warm-up classification; its failure is counted, not fatal"""
+    try:
+        fn(*args)
+    except NoMatchException:
+        pass
+    except RuleLogicException:
+        with warmup_state.lock:
+            warmup_state.errors += 1
+    except Exception as excp:
+        logger.warning(f"Warm-up classification failed: {excp}")
+        with warmup_state.lock:
+            warmup_state.errors += 1
+
+
+def _read_uuids(uuids_path: str):
+    with open(uuids_path) as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
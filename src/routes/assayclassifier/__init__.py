@@ -1,41 +1,107 @@
+import hashlib
 import logging
-from typing import Optional
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
-from flask import Blueprint, Response, jsonify, request
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from hubmap_commons.exceptions import HTTPException
 from hubmap_commons.hm_auth import AuthHelper
 from hubmap_sdk.sdk_helper import HTTPException as SDKException
 from werkzeug.exceptions import HTTPException as WerkzeugException
 
+from lib.auth import is_data_admin
+from lib.chain_diff import load_corpus, reload_report
+from lib.classification_cache import get_classification_cache, metadata_cache_key
+from lib.classification_store import get_classification_store, metadata_fingerprint
+from lib.classifier import InvalidRecord, read_ndjson
 from lib.decorators import require_json
+from lib.entity_classification import classify_uuid
+from lib.etags import add_validators, metadata_etag, not_modified
 from lib.exceptions import ResponseException
+from lib.preload import process_memory_usage
+from lib.profiling import install_profiling
 from lib.rule_chain import (
     NoMatchException,
+    RuleChain,
     RuleLogicException,
+    RulePatchException,
     RuleSyntaxException,
+    UnknownRuleChainException,
+    apply_rule_chain,
     build_entity_metadata,
     calculate_assay_info,
+    get_rule_chain,
     initialize_rule_chain,
+    normalize_metadata,
+    patch_rule_chain,
+    rule_chain_registry,
+    sync_shared_rule_chain,
 )
 from lib.services import get_entity
+from lib.shadow import shadow_monitor
+from lib.single_flight import SingleFlight
+from lib.stage_timing import install_stage_timing, stage, stage_timings
+from lib.warmup import start_warmup, warmup_state
 
 assayclassifier_blueprint = Blueprint("assayclassifier", __name__)
+install_stage_timing(assayclassifier_blueprint)
+install_profiling(assayclassifier_blueprint)
+
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Bulk requests look up this many records at a time in the classification cache
+BULK_CACHE_CHUNK = 100
+
+# Concurrent requests for the same uuid, auth token and chain share one
+# entity fetch and classification
+uuid_lookups = SingleFlight()
+
+
+@assayclassifier_blueprint.before_request
+def pick_up_published_chain():
+    """Switch to a chain another worker reloaded or patched, if any"""
+    try:
+        sync_shared_rule_chain()
+    except Exception as e:
+        # Keep serving the current chain
+        logger.error(e, exc_info=True)
+
 
 @assayclassifier_blueprint.route("/assaytype/<ds_uuid>", methods=["GET"])
 def get_ds_assaytype(ds_uuid: str):
     try:
-        token = get_token()
-        entity = get_entity(ds_uuid, token)
-        metadata = build_entity_metadata(entity)
-        return jsonify(calculate_assay_info(metadata))
+        with stage("get_token"):
+            token = get_token()
+        chain_selector = get_chain_selector()
+        if_none_match = request.if_none_match
+        with stage("lookup"):
+            rslt, etag = uuid_lookups.do(
+                uuid_lookup_key(
+                    ds_uuid, token, chain_selector, if_none_match.to_header()
+                ),
+                lambda: classify_uuid(ds_uuid, token, chain_selector, if_none_match),
+            )
+        if rslt is None:
+            return not_modified(etag)
+        with stage("jsonify"):
+            return add_validators(jsonify(rslt), etag)
     except ResponseException as re:
         logger.error(re, exc_info=True)
         return re.response
     except NoMatchException:
         return {}
+    except UnknownRuleChainException as excp:
+        return Response(str(excp), 404)
     except (RuleSyntaxException, RuleLogicException) as excp:
         return Response(f"Error applying classification rules: {excp}", 500)
     except WerkzeugException as excp:
@@ -55,10 +121,18 @@ def get_ds_assaytype(ds_uuid: str):
 @assayclassifier_blueprint.route("/assaytype/metadata/<ds_uuid>", methods=["GET"])
 def get_ds_rule_metadata(ds_uuid: str):
     try:
-        token = get_token()
-        entity = get_entity(ds_uuid, token)
-        metadata = build_entity_metadata(entity)
-        return jsonify(metadata)
+        with stage("get_token"):
+            token = get_token()
+        with stage("get_entity"):
+            entity = get_entity(ds_uuid, token)
+        with stage("build_entity_metadata"):
+            metadata = build_entity_metadata(entity)
+        with stage("etag"):
+            etag = metadata_etag(entity, metadata)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+        with stage("jsonify"):
+            return add_validators(jsonify(metadata), etag)
     except ResponseException as re:
         logger.error(re, exc_info=True)
         return re.response
@@ -84,12 +158,17 @@ def get_ds_rule_metadata(ds_uuid: str):
 @require_json(param="metadata")
 def get_assaytype_from_metadata(metadata: dict):
     try:
-        return jsonify(calculate_assay_info(metadata))
+        with stage("calculate_assay_info"):
+            rslt = calculate_assay_info(metadata, get_chain_selector())
+        with stage("jsonify"):
+            return jsonify(rslt)
     except ResponseException as re:
         logger.error(re, exc_info=True)
         return re.response
     except NoMatchException:
         return {}
+    except UnknownRuleChainException as excp:
+        return Response(str(excp), 404)
     except (RuleSyntaxException, RuleLogicException) as excp:
         return Response(f"Error applying classification rules: {excp}", 500)
     except WerkzeugException as excp:
@@ -106,11 +185,65 @@ def get_assaytype_from_metadata(metadata: dict):
         )
 
 
+@assayclassifier_blueprint.route("/assaytypes", methods=["POST"])
+def get_assaytypes_from_metadata_list():
+    """
+    Classify many metadata records in one call. The body is either a JSON
+    array of metadata dicts or, with content type application/x-ndjson, one
+    metadata dict per line. Results are streamed back as NDJSON in input
+    order, each written as soon as it is classified.
+    """
+    try:
+        # Resolved once, so every record is classified by the same chain
+        chain = get_rule_chain(get_chain_selector())
+        if request.mimetype == NDJSON_MIMETYPE:
+            records = read_ndjson(request.stream)
+        else:
+            records = request.get_json()
+            if not isinstance(records, list):
+                return Response("Request body must be a JSON array", 400)
+        return ndjson_response(classify_all(records, chain))
+    except ResponseException as re:
+        logger.error(re, exc_info=True)
+        return re.response
+    except UnknownRuleChainException as excp:
+        return Response(str(excp), 404)
+    except (RuleSyntaxException, RuleLogicException) as excp:
+        return Response(f"Error applying classification rules: {excp}", 500)
+    except WerkzeugException as excp:
+        return excp
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response(
+            "Unexpected error while getting assay types from metadata: " + str(e), 500
+        )
+
+
 @assayclassifier_blueprint.route("/reload-assaytypes", methods=["PUT"])
 def reload_chain():
+    """
+    Reload the rule chain from RULE_CHAIN_URI and publish it to the other
+    workers of the host. The report lists the stored results the new chain
+    changes, so reloading requires data admin privileges. Setting
+    ``RULE_CHAIN_RELOAD_ENABLED`` to false disables the route.
+    """
     try:
-        initialize_rule_chain()
-        return jsonify({})
+        if not current_app.config.get("RULE_CHAIN_RELOAD_ENABLED", True):
+            return Response("Rule chain reloading is disabled", 404)
+        if not is_data_admin():
+            return Response(
+                "Reloading the rule chain requires data admin privileges", 403
+            )
+        old_chain = rule_chain_registry.active()
+        initialize_rule_chain(publish=True)
+        report = reload_report(
+            old_chain,
+            rule_chain_registry.active(),
+            get_reclassify_corpus(old_chain),
+        )
+        # Refill the caches for the new chain in the background
+        start_warmup(current_app._get_current_object(), reload_chain=False)
+        return jsonify(report)
     except ResponseException as re:
         logger.error(re, exc_info=True)
         return re.response
@@ -126,6 +259,202 @@ def reload_chain():
         return Response("Unexpected error while reloading rule chain: " + str(e), 500)
 
 
+@assayclassifier_blueprint.route("/rule-chain", methods=["PATCH"])
+def patch_chain():
+    """
+    Insert, replace or remove individual rules, publishing the result as a
+    new active chain in this process. The body is {"operations": [...]} as
+    taken by RuleChain.patched, plus an optional "version" name for the new
+    chain. The chain patched is the active one, or the one given by ?chain=.
+
+    Patching is only possible when ``RULE_CHAIN_PATCH_ENABLED`` is set, and
+    only for callers with data admin privileges.
+    """
+    try:
+        if not current_app.config.get("RULE_CHAIN_PATCH_ENABLED", False):
+            return Response("Rule chain patching is disabled", 404)
+        if not is_data_admin():
+            return Response(
+                "Patching the rule chain requires data admin privileges", 403
+            )
+        body = request.get_json()
+        if not isinstance(body, dict) or not isinstance(body.get("operations"), list):
+            return Response('Request body must have an "operations" list', 400)
+        old_chain, new_chain = patch_rule_chain(
+            body["operations"], get_chain_selector(), body.get("version")
+        )
+        report = reload_report(old_chain, new_chain, get_reclassify_corpus(old_chain))
+        start_warmup(current_app._get_current_object(), reload_chain=False)
+        return jsonify(report)
+    except ResponseException as re:
+        logger.error(re, exc_info=True)
+        return re.response
+    except UnknownRuleChainException as excp:
+        return Response(str(excp), 404)
+    except (RulePatchException, RuleSyntaxException) as excp:
+        return Response(f"Invalid rule chain patch: {excp}", 400)
+    except WerkzeugException as excp:
+        return excp
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response("Unexpected error while patching rule chain: " + str(e), 500)
+
+
+@assayclassifier_blueprint.route("/rule-chains", methods=["GET"])
+def get_rule_chains():
+    try:
+        return jsonify(rule_chain_registry.describe())
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response("Unexpected error while listing rule chains: " + str(e), 500)
+
+
+@assayclassifier_blueprint.route("/ready", methods=["GET"])
+def get_readiness():
+    """
+    200 once this process has finished warming up, 503 while it is warming
+    up, and 500 if its first warm-up failed for good
+    """
+    state = warmup_state.describe()
+    if state["ready"]:
+        return jsonify(state), 200
+    return jsonify(state), 500 if state["status"] == "failed" else 503
+
+
+@assayclassifier_blueprint.route("/shadow-stats", methods=["GET"])
+def get_shadow_stats():
+    """
+    Shadow comparison statistics. Recent mismatches include the metadata of
+    the records compared, so this requires data admin privileges.
+    """
+    try:
+        if not is_data_admin():
+            return Response("Shadow stats require data admin privileges", 403)
+        return jsonify(shadow_monitor.describe())
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response("Unexpected error while reading shadow stats: " + str(e), 500)
+
+
+@assayclassifier_blueprint.route("/stage-timings", methods=["GET"])
+def get_stage_timings():
+    try:
+        return jsonify(stage_timings.describe())
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response("Unexpected error while reading stage timings: " + str(e), 500)
+
+
+@assayclassifier_blueprint.route("/memory-usage", methods=["GET"])
+def get_memory_usage():
+    try:
+        return jsonify(process_memory_usage())
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return Response("Unexpected error while reading memory usage: " + str(e), 500)
+
+
+def uuid_lookup_key(
+    ds_uuid: str,
+    token: Optional[str],
+    chain_selector: Optional[str],
+    if_none_match: str = "",
+) -> tuple:
+    """
+    Requests only share a lookup if they carry the same token, since what the
+    entity service returns depends on it. The token is hashed so it is not
+    held in memory any longer than the request itself holds it. Conditional
+    requests only share a lookup if they hold the same entity tags.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest() if token else None
+    return (ds_uuid, token_hash, chain_selector, if_none_match)
+
+
+def classify_all(records: Iterable[dict], chain: RuleChain) -> Iterator[dict]:
+    """
+    Classify the records of a bulk request in order with the given chain,
+    serving what it can from the classification cache, looked up and filled
+    a chunk at a time.
+    """
+    cache = get_classification_cache()
+    if cache is None:
+        for metadata in records:
+            yield classify_each(metadata, chain)
+        return
+    records = iter(records)
+    while chunk := list(islice(records, BULK_CACHE_CHUNK)):
+        chain_hash = chain.result_hash
+        keys = [
+            (
+                metadata_cache_key(chain_hash, metadata_fingerprint(metadata))
+                if isinstance(metadata, dict)
+                else None
+            )
+            for metadata in chunk
+        ]
+        cached = cache.get_many([key for key in keys if key is not None])
+        fresh = {}
+        for metadata, key in zip(chunk, keys):
+            if key in cached:
+                yield cached[key]
+                continue
+            rslt = classify_each(metadata, chain)
+            if "error" not in rslt:
+                fresh[key] = rslt
+            yield rslt
+        # Skip caching if a rule was disabled meanwhile
+        if chain.result_hash == chain_hash:
+            cache.set_many(fresh)
+
+
+def classify_each(metadata: dict, chain: RuleChain) -> dict:
+    """Classify one record of a bulk request; failures become part of the result"""
+    if isinstance(metadata, InvalidRecord):
+        return {"error": metadata.message}
+    if not isinstance(metadata, dict):
+        return {"error": "Record must be a JSON object"}
+    try:
+        return apply_rule_chain(chain, normalize_metadata(metadata))
+    except NoMatchException:
+        return {}
+    except (RuleSyntaxException, RuleLogicException) as excp:
+        return {"error": f"Error applying classification rules: {excp}"}
+    except Exception as e:
+        # The response is already streaming, so report it in place
+        logger.error(e, exc_info=True)
+        return {"error": f"Unexpected error while getting assay type: {e}"}
+
+
+def ndjson_response(records: Iterable[dict]) -> Response:
+    """Stream records as newline-delimited JSON, one line per record"""
+
+    def generate():
+        for rec in records:
+            yield current_app.json.dumps(rec) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def get_chain_selector() -> Optional[str]:
+    """The rule chain version or content hash requested via ?chain=, if any"""
+    return request.args.get("chain") or None
+
+
+def get_reclassify_corpus(old_chain) -> Optional[Iterable[dict]]:
+    """
+    The stored results to check after a reload: the RECLASSIFY_CORPUS_PATH
+    file if configured, else the classification store's entries from the
+    old chain, if there is a store.
+    """
+    corpus_path = current_app.config.get("RECLASSIFY_CORPUS_PATH")
+    if corpus_path:
+        return load_corpus(corpus_path)
+    store = get_classification_store()
+    if store is not None and old_chain is not None:
+        return store.export(chain_hash=old_chain.result_hash)
+    return None
+
+
 def get_token() -> Optional[str]:
     auth_helper_instance = AuthHelper.instance()
     token = auth_helper_instance.getAuthorizationTokens(request.headers)
@@ -1,11 +1,18 @@
 import json
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from pprint import pprint
 
 import yaml
 
+try:
+    # The libyaml-backed loader is much faster, but is not present in every build
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 ASSAY_TYPES_YAML = "assay_types.yaml"
 
 INGEST_VALIDATION_TABLE_PATH = "../../submodules/ingest_validation_tools/src/ingest_validation_tools/table-schemas/assays"
@@ -49,9 +56,7 @@ PREAMBLE = [
 ]
 
 
-def get_assay_list(table_schema_path):
-    with open(table_schema_path) as f:
-        dct = yaml.safe_load(f)
+def get_assay_list(table_schema_path, dct):
     try:
         assay_lst = []
         for fld_dct in dct["fields"]:
@@ -68,20 +73,30 @@ def get_assay_list(table_schema_path):
     return assay_lst
 
 
-def test_is_hca(table_schema_path):
-    with open(table_schema_path) as f:
-        for line in f:
-            if (
-                line.lower().startswith("# include:")
-                and "../includes/fields/source_project.yaml" in line
-            ):
-                return True
+def test_is_hca(schema_text):
+    for line in schema_text.splitlines():
+        if (
+            line.lower().startswith("# include:")
+            and "../includes/fields/source_project.yaml" in line
+        ):
+            return True
     return False
 
 
+def parse_table_schema(table_schema_path):
+    """
+    Read a table schema once and return (assay_lst, is_hca).  This runs in
+    a worker process, so it must stay a module-level function.
+    """
+    with open(table_schema_path) as f:
+        schema_text = f.read()
+    dct = yaml.load(schema_text, Loader=SafeLoader)
+    return get_assay_list(table_schema_path, dct), test_is_hca(schema_text)
+
+
 def main() -> None:
     with open(ASSAY_TYPES_YAML) as f:
-        old_assay_types_dict = yaml.safe_load(f)
+        old_assay_types_dict = yaml.load(f, Loader=SafeLoader)
 
     table_dir_path = Path(INGEST_VALIDATION_TABLE_PATH)
     split_regex = re.compile(SCHEMA_SPLIT_REGEX)
@@ -90,6 +105,7 @@ def main() -> None:
     schema_name_to_filename_dict = {}
     dir_schema_version_dict = defaultdict(list)
     schema_name_to_name_list_dict = defaultdict(list)
+    table_schema_list = []
     for table_schema_path in table_dir_path.glob("*.yaml"):
         m = split_regex.match(table_schema_path.stem)
         if m:
@@ -101,8 +117,22 @@ def main() -> None:
                 "Failed to parse schema name from table"
                 f" schema {table_schema_path.name}"
             )
-        is_hca = test_is_hca(table_schema_path)
-        assay_lst = get_assay_list(table_schema_path)
+        table_schema_list.append((table_schema_path, schema_name, schema_version))
+    # Parsing the schemas dominates the run time, so spread it across processes.
+    # executor.map preserves input order, so the dicts below fill in the same order
+    # as a serial loop would.
+    with ProcessPoolExecutor() as executor:
+        parsed_schema_list = list(
+            executor.map(
+                parse_table_schema,
+                [tpl[0] for tpl in table_schema_list],
+                chunksize=8,
+            )
+        )
+    for (table_schema_path, schema_name, schema_version), (
+        assay_lst,
+        is_hca,
+    ) in zip(table_schema_list, parsed_schema_list):
         for elt in assay_lst:
             name_to_schema_name_dict[
                 (elt.lower(), schema_version, is_hca)